@@ -268,7 +268,7 @@ namespace Beckadam.C2AnimCVR
                 dpath = AssetDatabase.GetAssetPath(sourceAsm);
             }
             Process buildCmd = CreateCmdProcess("Assets/Beckadam/C2AnimCVR/Scripts",
-                   $"python c2animcvr.py ../../../../{AssetDatabase.GetAssetPath(source)} -o ../../../../{dpath}",
+                   $"python -m c2animcvr ../../../../{AssetDatabase.GetAssetPath(source)} -o ../../../../{dpath}",
                    hideConsoleWindow);
             buildCmd.Start();
             buildCmd.WaitForExit();
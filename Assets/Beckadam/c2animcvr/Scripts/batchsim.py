@@ -0,0 +1,266 @@
+import sys, time
+from binaryir import Program, PARAM, BOOL
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def Float32(v):
+    """ Rounds every value of v to the nearest float the animator can hold """
+    return v.astype(np.float32).astype(np.float64)
+
+def Truthy(v):
+    return v >= 0.5
+
+def NanUnlessFinite(result, *args):
+    """ Python raises instead of returning a non-finite result from finite arguments, which the simulator turns into nan """
+    finite = np.isfinite(args[0])
+    for a in args[1:]:
+        finite = finite & np.isfinite(a)
+    return np.where(finite & ~np.isfinite(result), np.nan, result)
+
+def Integer(f):
+    """ Returns f taking the integer parts of its arguments, with nan where an argument is not finite like simulator.Guarded """
+    def g(*args):
+        finite = np.isfinite(args[0])
+        for a in args[1:]:
+            finite = finite & np.isfinite(a)
+        ints = [np.where(finite, np.trunc(a), 0).astype(np.int64) for a in args]
+        return np.where(finite, f(*ints).astype(np.float64), np.nan)
+    return g
+
+def Div(a, b):
+    # a/0 is inf with the sign of a, 0/0 is nan
+    return np.where(b == 0, np.where(a == 0, np.nan, np.copysign(np.inf, a)), a / np.where(b == 0, 1, b))
+
+def Log(a):
+    return np.where(a <= 0, np.nan, np.log(np.where(a <= 0, 1, a)))
+
+def IPart(a):
+    return np.where(np.isfinite(a), np.trunc(a), np.nan)
+
+def Shl(a, b):
+    return NanUnlessFinite(np.trunc(a) * np.power(2.0, np.trunc(b)), a, b)
+
+def Shr(a, b):
+    return NanUnlessFinite(np.floor_divide(np.trunc(a), np.power(2.0, np.trunc(b))), a, b)
+
+# the vectorized equivalents of simulator.OPERATORS
+OPERATORS = {
+    "set": lambda a: a,
+    "add": lambda a,b: a + b,
+    "sub": lambda a,b: a - b,
+    "mul": lambda a,b: a * b,
+    "div": Div,
+    "mod": lambda a,b: np.fmod(a, b),
+    "pow": lambda a,b: NanUnlessFinite(np.power(a, b), a, b),
+    "log": Log,
+    "eq": lambda a,b: (a == b).astype(np.float64),
+    "ne": lambda a,b: (a != b).astype(np.float64),
+    "lt": lambda a,b: (a < b).astype(np.float64),
+    "le": lambda a,b: (a <= b).astype(np.float64),
+    "gt": lambda a,b: (a > b).astype(np.float64),
+    "ge": lambda a,b: (a >= b).astype(np.float64),
+    "ip": IPart,
+    "fp": lambda a: a - IPart(a),
+    "land": lambda a,b: (Truthy(a) & Truthy(b)).astype(np.float64),
+    "lor": lambda a,b: (Truthy(a) | Truthy(b)).astype(np.float64),
+    "and": Integer(lambda a,b: a & b),
+    "or": Integer(lambda a,b: a | b),
+    "xor": Integer(lambda a,b: a ^ b),
+    "shl": Shl,
+    "shr": Shr,
+    "rol": Integer(lambda a,b: (a << (b % 32) | (a & 0xffffffff) >> (32 - b % 32)) & 0xffffffff),
+    "ror": Integer(lambda a,b: ((a & 0xffffffff) >> (b % 32) | a << (32 - b % 32)) & 0xffffffff),
+    "cond": lambda a,b,c: np.where(Truthy(a), b, c),
+}
+
+
+class BatchSimulator:
+    """ Runs one program over many inputs at once, with the results simulator.Simulator would give for each of them.
+    Every parameter is a column holding its value in every lane, each layer keeps the current state of every lane,
+    and each frame runs the tasks of a state for all the lanes that enter it together.
+    Integer operators work on 64 bit integers, so they differ from the simulator for values beyond 2**63. """
+    def __init__(self, text: str):
+        if np is None:
+            raise RuntimeError("The batch simulator requires numpy")
+        self.program = Program.FromText(text)
+        self.names = []
+        self.columns = {}
+        for kind, name in self.program.params:
+            self.Column(name)
+        # the column and type of each interned parameter, parameters share a column by name like animator parameters
+        self.param_columns = [self.columns[name] for kind, name in self.program.params]
+        self.param_types = [kind for kind, name in self.program.params]
+        self.outputs = [self.param_columns[param] for param, obj, path in self.program.outputs]
+        self.layers = []
+        for layer in self.program.layers:
+            if not len(layer["states"]):
+                continue
+            states = []
+            for state in layer["states"]:
+                tasks = [(OPERATORS[op], self.param_columns[operands[0][1]], self.param_types[operands[0][1]],
+                          [self.Operand(o) for o in operands[1:]]) for op, operands in state["tasks"]]
+                transitions = [(self.param_columns[param], dest, unless) for param, dest, unless in state["transitions"]]
+                states.append((tasks, transitions, -1 if state["after"] is None else state["after"]))
+            self.layers.append(states)
+
+    def Column(self, name: str) -> int:
+        if name not in self.columns:
+            self.columns[name] = len(self.names)
+            self.names.append(name)
+        return self.columns[name]
+
+    def Operand(self, operand):
+        """ Returns (True, column) for a parameter or (False, value) for a constant """
+        kind, value = operand
+        if kind == PARAM:
+            return (True, self.param_columns[value])
+        if kind == BOOL:
+            return (False, 1.0 if value else 0.0)
+        # the assembler keeps every constant in a float
+        return (False, float(np.float32(value)))
+
+    def Store(self, values, column: int, kind: str, lanes, result):
+        result = np.asarray(result, dtype=np.float64)
+        if kind == "i":
+            result = np.where(np.isfinite(result), np.trunc(result), 0.0)
+        elif kind in ("b", "t"):
+            result = Truthy(result).astype(np.float64)
+        values[column, lanes] = Float32(np.broadcast_to(result, lanes.shape))
+
+    def Enter(self, values, state, lanes):
+        """ Runs the tasks of state in the given lanes """
+        for f, target, kind, args in state[0]:
+            self.Store(values, target, kind, lanes, f(*[values[a, lanes] if is_param else a for is_param, a in args]))
+
+    def Next(self, values, state, lanes):
+        """ Returns the index of the state each of lanes goes to from state, or -1 """
+        dest = np.full(lanes.shape, state[2], dtype=np.int64)
+        # the first transition that holds wins, so the earliest ones are applied last
+        for column, target, unless in reversed(state[1]):
+            v = values[column, lanes]
+            dest = np.where((v < 1.0) if unless else (v > 0.0), target, dest)
+        return dest
+
+    def UpdateMemory(self, values, memories, lanes):
+        for mem, cells in memories:
+            addr, value, read, write = [self.param_columns[p] for p in mem[2:]]
+            index = values[addr, lanes] - mem[0]
+            inside = (index == np.floor(index)) & (index >= 0) & (index < mem[1])
+            cell = np.where(inside, index, 0).astype(np.int64)
+            reading = Truthy(values[read, lanes])
+            hit = reading & inside
+            values[value, lanes[hit]] = cells[cell[hit], lanes[hit]]
+            values[read, lanes[reading]] = 0.0
+            writing = Truthy(values[write, lanes])
+            hit = writing & inside
+            cells[cell[hit], lanes[hit]] = values[value, lanes[hit]]
+            values[write, lanes[writing]] = 0.0
+
+    def Run(self, inputs: dict = None, lanes: int = None, max_frames: int = 100000) -> dict:
+        """ Runs the program once per lane, where inputs maps parameter names to a value or an array with one value per lane.
+        The number of lanes is taken from the arrays in inputs when it is not given.
+        Returns the final value of every parameter and the frames, states entered and whether it halted, per lane. """
+        inputs = {name: np.asarray(v, dtype=np.float64) for name, v in (inputs or {}).items()}
+        if lanes is None:
+            lanes = max([v.size for v in inputs.values() if v.ndim > 0], default=1)
+        for name in inputs.keys():
+            self.Column(name)
+        values = np.zeros((len(self.names), lanes))
+        for name, v in inputs.items():
+            values[self.columns[name]] = np.broadcast_to(v.reshape(-1) if v.ndim else v, (lanes,))
+        memories = [(mem, np.zeros((mem[1], lanes))) for mem in self.program.memories]
+        current = [np.zeros(lanes, dtype=np.int64) for layer in self.layers]
+        frames = np.full(lanes, max_frames, dtype=np.int64)
+        states = np.zeros(lanes, dtype=np.int64)
+        halted = np.zeros(lanes, dtype=bool)
+        active = np.arange(lanes)
+
+        with np.errstate(all="ignore"):
+            for layer in self.layers:
+                self.Enter(values, layer[0], active)
+            states += len(self.layers)
+            self.UpdateMemory(values, memories, active)
+            frame = 1
+            while frame < max_frames and len(active):
+                moved = np.zeros(len(active), dtype=bool)
+                for layer, cur in zip(self.layers, current):
+                    here = cur[active]
+                    dest = np.full(len(active), -1, dtype=np.int64)
+                    for s in np.unique(here):
+                        group = np.nonzero(here == s)[0]
+                        dest[group] = self.Next(values, layer[s], active[group])
+                    going = dest >= 0
+                    moved |= going
+                    cur[active[going]] = dest[going]
+                    for s in np.unique(dest[going]):
+                        self.Enter(values, layer[s], active[dest == s])
+                    states[active[going]] += 1
+                # a lane where no layer moved can never move again
+                frames[active[~moved]] = frame
+                halted[active[~moved]] = True
+                active = active[moved]
+                frame += 1
+                self.UpdateMemory(values, memories, active)
+
+        return {
+            "lanes": lanes,
+            "frames": frames,
+            "states": states,
+            "halted": halted,
+            "outputs": {self.names[c]: values[c] for c in self.outputs},
+            "params": {name: values[self.columns[name]] for name in self.names},
+        }
+
+
+def Grid(ranges: dict) -> dict:
+    """ Returns inputs covering every combination of the values of ranges, a name:array-like dictionary """
+    names = list(ranges.keys())
+    mesh = np.meshgrid(*[np.asarray(ranges[name], dtype=np.float64) for name in names], indexing="ij")
+    return {name: m.reshape(-1) for name, m in zip(names, mesh)}
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print(f"Usage: {sys.argv[0]} program.asm [--range name=start:stop:count] [--set name=value] [--max-frames n] [--json]")
+        exit(0)
+
+    ifile = sys.argv[1]
+    max_frames = 100000
+    ranges = {}
+    as_json = False
+    for i in range(2, len(sys.argv)):
+        if sys.argv[i] == "--max-frames" and i+1 < len(sys.argv):
+            max_frames = int(sys.argv[i+1])
+        elif sys.argv[i] == "--range" and i+1 < len(sys.argv):
+            name, value = sys.argv[i+1].split("=", maxsplit=1)
+            start, stop, count = value.split(":")
+            ranges[name] = np.linspace(float(start), float(stop), int(count))
+        elif sys.argv[i] == "--set" and i+1 < len(sys.argv):
+            name, value = sys.argv[i+1].split("=", maxsplit=1)
+            ranges[name] = [float(value)]
+        elif sys.argv[i] == "--json":
+            as_json = True
+
+    with open(ifile) as f:
+        sim = BatchSimulator(f.read())
+    start = time.perf_counter()
+    results = sim.Run(Grid(ranges), max_frames=max_frames)
+    seconds = time.perf_counter() - start
+    summary = {
+        "lanes": results["lanes"],
+        "seconds": seconds,
+        "halted": int(results["halted"].sum()),
+        "frames": {"min": int(results["frames"].min()), "mean": float(results["frames"].mean()), "max": int(results["frames"].max())},
+        "params": {name: {"min": float(v.min()), "mean": float(v.mean()), "max": float(v.max())} for name, v in results["params"].items()},
+    }
+    if as_json:
+        import json
+        print(json.dumps(summary, indent=2))
+    else:
+        print(f"{summary['lanes']} lanes in {seconds:.3f}s, {summary['halted']} halted, "
+              f"frames min {summary['frames']['min']} mean {summary['frames']['mean']:.1f} max {summary['frames']['max']}")
+        for name, stats in summary["params"].items():
+            print(f"{'output ' if results['outputs'].get(name) is not None else ''}{name}: min {stats['min']} mean {stats['mean']} max {stats['max']}")
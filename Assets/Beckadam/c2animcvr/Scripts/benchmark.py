@@ -0,0 +1,334 @@
+import os, sys, time, json, platform, tempfile, compileall, subprocess, tracemalloc
+from c2animcvr import Compiler, CompilerVersion
+
+SCRIPTS = os.path.dirname(os.path.abspath(__file__))
+EXAMPLES = os.path.join(SCRIPTS, "..", "examples")
+
+
+def NestedProgram(statements: int, depth: int = 8) -> str:
+    """ Generates a program of roughly the given number of statements made of for/while loops nested depth deep,
+    each containing an if block """
+    lines = []
+    count = 0
+    n = 0
+    while count < statements:
+        n += 1
+        for d in range(depth):
+            pad = "  " * d
+            if d % 2 == 0:
+                lines.append(f"{pad}for I{d}=0; I{d}<4; I{d}=I{d}+1;")
+                count += 3
+            else:
+                lines.append(f"{pad}while W{d} < {d+4};")
+                lines.append(f"{pad}  W{d} = W{d} + 1;")
+                count += 2
+            # loops are not allowed inside if blocks, so every if is closed right away
+            lines.append(f"{pad}  if V{d} > {d};")
+            lines.append(f"{pad}    V{d} = V{d} + {n} * I0;")
+            lines.append(f"{pad}  end")
+            count += 3
+        for d in reversed(range(depth)):
+            lines.append("  " * d + "end")
+            count += 1
+    return "\n".join(lines) + "\n"
+
+
+def IfElseProgram(statements: int, depth: int = 12) -> str:
+    """ Generates if/else blocks nested depth deep, repeated until there are roughly the given number of statements """
+    lines = []
+    count = 0
+    n = 0
+    while count < statements:
+        n += 1
+        for d in range(depth):
+            pad = "  " * d
+            lines.append(f"{pad}if C{d} > {n % 7};")
+            lines.append(f"{pad}  V{d} = V{d} + {d} * C{d};")
+            count += 2
+        for d in reversed(range(depth)):
+            pad = "  " * d
+            # else is only recognized straight after the ";" ending the if block
+            lines.append(f"{pad}end;else;")
+            lines.append(f"{pad}  V{d} = V{d} - {n};")
+            lines.append(f"{pad}end")
+            count += 4
+    for d in range(depth):
+        lines.append(f"output V{d};")
+    return "\n".join(lines) + "\n"
+
+
+def StraightLineProgram(statements: int, inputs: int = 8) -> str:
+    """ Generates one long run of arithmetic assignments, each depending on the ones before it """
+    lines = []
+    for i in range(statements):
+        lines.append(f"X{i} = X{max(i-1, 0)} * 3 + Y{i % inputs} - {i} / (Y{(i+1) % inputs} + 1);")
+    lines.append(f"output X{statements-1};")
+    return "\n".join(lines) + "\n"
+
+
+def LabelProgram(statements: int) -> str:
+    """ Generates many labels, each followed by a while loop and a repeat loop """
+    lines = []
+    count = 0
+    n = 0
+    while count < statements:
+        n += 1
+        lines.append(f"label L{n};")
+        lines.append(f"A = A + {n};")
+        lines.append(f"while B < {n};")
+        lines.append(f"  B = B + A;")
+        lines.append(f"end")
+        lines.append(f"repeat C < {n % 13};")
+        lines.append(f"  C = C + 1;")
+        lines.append(f"end")
+        count += 8
+    lines.append("output A;")
+    lines.append("output B;")
+    lines.append("output C;")
+    return "\n".join(lines) + "\n"
+
+
+def WideProgram(statements: int, width: int = 64) -> str:
+    """ Generates assignments of width-term expressions with nested parentheses """
+    lines = []
+    for i in range(statements // width + 1):
+        terms = [f"(A{j} * B{(i+j) % width} + {j})" for j in range(width)]
+        lines.append(f"W{i} = " + " - ".join(terms) + ";")
+        lines.append(f"output W{i};")
+    return "\n".join(lines) + "\n"
+
+
+def ArrayProgram(statements: int, size: int = 8, dynamic: int = 16) -> str:
+    """ Generates reads and writes of an array, one in every dynamic of them at an index only known at runtime """
+    lines = [f"array cells[{size}];"]
+    for i in range(statements):
+        if i % dynamic == 0:
+            lines.append(f"cells[I{i % 4}] = X{i % 16} + {i};")
+        elif i % dynamic == dynamic // 2:
+            lines.append(f"X{i % 16} = cells[J{i % 4}] + X{(i+1) % 16};")
+        else:
+            lines.append(f"cells[{i % size}] = cells[{(i+1) % size}] * 2 + X{i % 16};")
+    lines.append("output X0;")
+    return "\n".join(lines) + "\n"
+
+
+PROGRAMS = {
+    "nested": NestedProgram,
+    "ifelse": IfElseProgram,
+    "straight": StraightLineProgram,
+    "labels": LabelProgram,
+    "wide": WideProgram,
+    "arrays": ArrayProgram,
+}
+
+
+def Timed(f, *args):
+    t = time.perf_counter()
+    result = f(*args)
+    return time.perf_counter() - t, result
+
+
+def BenchNested(statements: int = 50000, depth: int = 8, repeat: int = 3):
+    source = NestedProgram(statements, depth)
+    best = None
+    for i in range(repeat):
+        comp = Compiler(source)
+        comp.PreprocessSource()
+        parsed = []
+        t, _ = Timed(comp._Compile, 0, parsed)
+        if best is None or t < best:
+            best = t
+    cache = comp.parse_cache
+    print(f"nested: {len(comp.statements)} statements, depth {depth}, {len(parsed)} parsed lines, _Compile {best*1000:.1f} ms")
+    print(f"nested: parse cache {cache.hits} hits, {cache.misses} misses, {len(cache.entries)} entries")
+    return {
+        "statements": len(comp.statements),
+        "parsed": len(parsed),
+        "seconds": best,
+        "cache_hits": cache.hits,
+        "cache_misses": cache.misses,
+    }
+
+
+def ExampleExpressions() -> list:
+    """ Returns every expression string the compiler hands to the parser while compiling the examples """
+    expressions = []
+    for name in sorted(os.listdir(EXAMPLES)):
+        if not name.endswith(".txt"):
+            continue
+        with open(os.path.join(EXAMPLES, name)) as f:
+            comp = Compiler(f.read())
+        parse = comp.parser.parse
+        def record(expr):
+            expressions.append(expr)
+            return parse(expr)
+        comp.parser.parse = record
+        comp.Compile()
+    return expressions
+
+
+def BenchParser(scale: int = 1000, repeat: int = 3):
+    expressions = ExampleExpressions() * scale
+    comp = Compiler("")
+    best = None
+    for i in range(repeat):
+        tokens = 0
+        t = time.perf_counter()
+        for expr in expressions:
+            tokens += len(comp.parser.parse(expr).tokens)
+        t = time.perf_counter() - t
+        if best is None or t < best:
+            best = t
+    print(f"parser: {len(expressions)} expressions, {tokens} tokens in {best*1000:.1f} ms, {tokens/best:.0f} tokens/sec")
+    return {
+        "expressions": len(expressions),
+        "tokens": tokens,
+        "seconds": best,
+        "tokens_per_second": tokens / best,
+    }
+
+
+def CompilePhases(source: str):
+    """ Compiles source, returning the seconds spent in each pass of Compiler.Compile and in building
+    the assembly, and the compiler """
+    comp = Compiler(source)
+    comp.Compile()
+    times = dict(comp.phase_times)
+    times["assembly"], _ = Timed(comp.BuildAssembly)
+    times["finalize"], _ = Timed(comp.Finalize)
+    return times, comp
+
+
+def PeakMemory(source: str) -> int:
+    """ Returns the most memory in bytes allocated at once while compiling source """
+    tracemalloc.start()
+    try:
+        comp = Compiler(source)
+        comp.Compile()
+        comp.BuildAssembly()
+        comp.Finalize()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def BenchPrograms(sizes: tuple = (1000, 10000), repeat: int = 3):
+    results = []
+    for name, generate in PROGRAMS.items():
+        for size in sizes:
+            source = generate(size)
+            best = None
+            for i in range(repeat):
+                times, comp = CompilePhases(source)
+                if best is None:
+                    best = times
+                else:
+                    best = {k: min(best[k], times[k]) for k in best}
+            peak = PeakMemory(source)
+            states = sum(len(layer["states"]) for layer in comp.layers)
+            instructions = sum(len(st["instructions"]) for layer in comp.layers for st in layer["states"].values())
+            total = sum(best.values())
+            phases = ", ".join(f"{k} {v*1000:.1f}" for k, v in best.items())
+            print(f"programs: {name} {size}: {total*1000:.1f} ms ({phases}), peak {peak/1024/1024:.1f} MiB, {states} states, {instructions} instructions")
+            results.append({
+                "program": name,
+                "size": size,
+                "statements": len(comp.statements),
+                "states": states,
+                "instructions": instructions,
+                "assembly_lines": len(comp.assembly),
+                "seconds": total,
+                "phases": best,
+                "peak_bytes": peak,
+            })
+    return results
+
+
+def Median(values: list) -> float:
+    values = sorted(values)
+    return (values[(len(values)-1) // 2] + values[len(values) // 2]) / 2
+
+
+def TimeProcess(args: list, repeat: int) -> float:
+    """ Returns the median wall clock seconds of running python with args in a new process from the scripts directory """
+    times = []
+    for i in range(repeat):
+        t = time.perf_counter()
+        subprocess.run([sys.executable] + args, cwd=SCRIPTS, check=True, stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - t)
+    return Median(times)
+
+
+def ImportTimes(args: list) -> list:
+    """ Runs python -X importtime with args, returning every import as {"module", "self_us", "cumulative_us"}
+    in import order """
+    result = subprocess.run([sys.executable, "-X", "importtime"] + args, cwd=SCRIPTS, check=True,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    imports = []
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        own, cumulative, module = line[len("import time:"):].split("|")
+        imports.append({"module": module.strip(), "self_us": int(own), "cumulative_us": int(cumulative)})
+    return imports
+
+
+def BenchStartup(example: str = "hello_world.txt", repeat: int = 15):
+    """ Times compiling one example the way the Unity editor does, with python -m c2animcvr in a new process,
+    against a fresh cache so every run is comparable """
+    source = os.path.join(EXAMPLES, example)
+    with tempfile.TemporaryDirectory() as tmp:
+        output = os.path.join(tmp, "out.asm")
+        build = ["-m", "c2animcvr", source, "-o", output, "--cache-dir", os.path.join(tmp, "cache")]
+        # the editor runs with the bytecode of the compiler written, which python may be told not to do
+        compileall.compile_dir(SCRIPTS, maxlevels=0, quiet=1)
+        # fills the cache
+        TimeProcess(build, 1)
+        results = {
+            "example": example,
+            "python_seconds": TimeProcess(["-c", "pass"], repeat),
+            "cache_hit_seconds": TimeProcess(build, repeat),
+            "no_cache_seconds": TimeProcess(build + ["--no-cache"], repeat),
+            "imports": ImportTimes(build + ["--no-cache"]),
+        }
+    print(f"startup: {example}, median of {repeat}: python {results['python_seconds']*1000:.1f} ms, "
+          f"cache hit {results['cache_hit_seconds']*1000:.1f} ms, no cache {results['no_cache_seconds']*1000:.1f} ms")
+    slowest = sorted(results["imports"], key=lambda i: i["self_us"], reverse=True)[:10]
+    print("startup: slowest imports " + ", ".join(f"{i['module']} {i['self_us']/1000:.1f}" for i in slowest) + " ms")
+    return results
+
+
+BENCHMARKS = {
+    "nested": BenchNested,
+    "parser": BenchParser,
+    "programs": BenchPrograms,
+    "startup": BenchStartup,
+}
+
+if __name__ == '__main__':
+    names = []
+    output = "benchmark_results.json"
+    i = 1
+    while i < len(sys.argv):
+        if sys.argv[i] in ("-o", "--output") and i+1 < len(sys.argv):
+            output = sys.argv[i+1]
+            i += 1
+        else:
+            names.append(sys.argv[i])
+        i += 1
+    names = names or list(BENCHMARKS.keys())
+    results = {
+        "version": CompilerVersion(),
+        "python": platform.python_version(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "benchmarks": {},
+    }
+    for name in names:
+        if name not in BENCHMARKS:
+            print(f"Unknown benchmark \"{name}\", available: {', '.join(BENCHMARKS.keys())}")
+            exit(1)
+        results["benchmarks"][name] = BENCHMARKS[name]()
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}")
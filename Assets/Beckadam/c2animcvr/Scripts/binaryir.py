@@ -0,0 +1,533 @@
+import sys, struct
+
+# Binary form of the assembly read by AnimatorCompiler.cs, so a program can be loaded without parsing text.
+# Everything is little-endian, counts and indices are unsigned LEB128 varints.
+#   header    "C2IR", u8 version
+#   speed     u8 present, f32 speed when present
+#   strings   count, then each: length, utf-8 bytes          (names of parameters, layers, states, output objects)
+#   params    count, then each: u8 type ('f','i','b','t'), name string, u8 declared by var
+#   outputs   count, then each: param, object string, path string + 1 (0 when there is no path)
+#   memories  count, then each: i32 base, i32 size, address, value, read and write params
+#   layers    count, then each: name string, state count, then each state:
+#               name string, task count, tasks, transition count, transitions, goto state + 1 (0 when there is none)
+#   task        u8 opcode, then one operand per argument of the opcode, the target first
+#   operand     u8 kind: 0 param (then index), 1 int (i32), 2 float (f32), 3 bool (u8)
+#   transition  u8 unless, condition param, state index
+# Macros are expanded when the text is read, like the assembler does, so only opcodes reach the binary form.
+
+MAGIC = b"C2IR"
+VERSION = 1
+
+# in the order of AnimatorCompiler.TryGetOperator, the index is the opcode byte
+OPCODES = ("set", "add", "sub", "mul", "div", "mod", "pow", "log", "eq", "ne", "lt", "le", "gt", "ge", "ip", "fp",
+           "land", "lor", "and", "or", "xor", "shl", "shr", "rol", "ror", "cond")
+OPCODE_BYTES = {op: i for i, op in enumerate(OPCODES)}
+
+PARAM, INT, FLOAT, BOOL = range(4)
+PARAM_TYPES = "fibt"
+
+
+class IRError(RuntimeError):
+    pass
+
+
+def Arity(op: str) -> int:
+    """ Number of operands of op, including the target """
+    if op in ("set", "ip", "fp", "log"):
+        return 2
+    if op == "cond":
+        return 4
+    return 3
+
+def Float32(v: float) -> float:
+    return struct.unpack("<f", struct.pack("<f", v))[0]
+
+def Int32(v: int) -> int:
+    return (v + 0x80000000) % 0x100000000 - 0x80000000
+
+def FormatFloat(v: float) -> str:
+    """ Shortest text that reads back as the same float, always with a point or exponent so it is not read as an int """
+    for digits in range(1, 10):
+        s = f"{v:.{digits}g}"
+        if Float32(float(s)) == v:
+            s = repr(float(s))
+            break
+    if "." not in s and "e" not in s:
+        s += ".0"
+    return s
+
+
+class Program:
+    """ An assembly program with its parameters interned. Operands are (kind, value) pairs where a PARAM value is an
+    index into params, states are referred to by their index within the layer. """
+    def __init__(self):
+        self.speed = None
+        # (type, name) of every parameter referenced, and whether it was declared by var
+        self.params = []
+        self.declared = []
+        self.param_index = {}
+        self.outputs = []
+        self.memories = []
+        self.layers = []
+
+    def __eq__(self, other):
+        return type(other) is Program and (self.speed, self.params, self.declared, self.outputs, self.memories, self.layers) == \
+            (other.speed, other.params, other.declared, other.outputs, other.memories, other.layers)
+
+    def Param(self, kind: str, name: str) -> int:
+        key = (kind, name)
+        if key not in self.param_index:
+            self.param_index[key] = len(self.params)
+            self.params.append(key)
+            self.declared.append(False)
+        return self.param_index[key]
+
+    def ParamName(self, index: int) -> str:
+        return "".join(self.params[index])
+
+    def Operand(self, s: str):
+        """ Reads an operand the way AnimatorCompiler.Variable.FromString does """
+        s = s.strip(" \t")
+        if not len(s):
+            return (FLOAT, 0.0)
+        if s == "true":
+            return (BOOL, True)
+        if s == "false":
+            return (BOOL, False)
+        if s.startswith("0x"):
+            num = 0
+            for c in s[2:]:
+                if c in "0123456789abcdefABCDEF":
+                    num = Int32(num * 16 + int(c, 16))
+            return (INT, num)
+        if s[0] in "0123456789-.":
+            try:
+                v = int(s)
+                if -0x80000000 <= v < 0x80000000:
+                    return (INT, v)
+            except ValueError:
+                pass
+            try:
+                return (FLOAT, Float32(float(s)))
+            except ValueError:
+                return (FLOAT, 0.0)
+        if s[0] not in PARAM_TYPES:
+            raise IRError(f"Failed to determine variable type: {s}")
+        return (PARAM, self.Param(s[0], s[1:]))
+
+    def FormatOperand(self, operand) -> str:
+        kind, value = operand
+        if kind == PARAM:
+            return self.ParamName(value)
+        if kind == INT:
+            return str(value)
+        if kind == BOOL:
+            return "true" if value else "false"
+        return FormatFloat(value)
+
+    @staticmethod
+    def FromText(text: str) -> "Program":
+        return Program.FromLines(text.split("\n"))
+
+    @staticmethod
+    def FromLines(lines) -> "Program":
+        """ Reads assembly from an iterable of lines, such as Compiler.IterAssembly() """
+        program = Program()
+        reader = TextReader(program)
+        reader.Read(lines)
+        reader.Resolve()
+        return program
+
+    def IterText(self):
+        """ Yields the lines of the text form, which reads back as an equal Program """
+        if self.speed is not None:
+            yield f"speed {FormatFloat(self.speed)}"
+        for i in range(len(self.params)):
+            if self.declared[i]:
+                yield f"var {self.ParamName(i)}"
+        for mem in self.memories:
+            yield f"memory {mem[0]}, {mem[1]}, " + ", ".join(self.ParamName(p) for p in mem[2:])
+        for param, obj, path in self.outputs:
+            yield f"output {self.ParamName(param)}, {obj}" + (f", {path}" if path is not None else "")
+        for layer in self.layers:
+            yield f"layer {layer['name']}"
+            names = [state["name"] for state in layer["states"]]
+            for state in layer["states"]:
+                yield f"state {state['name']}"
+                for op, operands in state["tasks"]:
+                    yield f"{op} " + ", ".join(self.FormatOperand(o) for o in operands)
+                for param, dest, unless in state["transitions"]:
+                    yield f"{'goto_unless' if unless else 'goto_if'} {self.ParamName(param)}, {names[dest]}"
+                if state["after"] is not None:
+                    yield f"goto {names[state['after']]}"
+                yield "end state"
+            yield "end layer"
+
+    def ToText(self) -> str:
+        return "\n".join(self.IterText())
+
+
+class TextReader:
+    """ Reads text assembly into a Program, following AnimatorCompiler.Parse """
+    def __init__(self, program: Program):
+        self.program = program
+        self.macros = {}
+        self.macro = None
+        self.layer = None
+        self.state = None
+        self.lineno = 0
+
+    def Error(self, m: str):
+        raise IRError(f"Error on line {self.lineno}: {m}")
+
+    def Read(self, lines):
+        for line in lines:
+            self.lineno += 1
+            try:
+                self.Line(line)
+            except IRError as e:
+                if str(e).startswith("Error on line"):
+                    raise
+                self.Error(str(e))
+
+    def Line(self, line: str):
+        line = line.strip(" \t\r")
+        if len(line) < 2 or line[0] == ';':
+            return
+        if self.macro is not None:
+            if line == "end macro":
+                self.macros[self.macro[0]] = self.macro[1:]
+                self.macro = None
+            else:
+                self.macro[2].append(line)
+            return
+        program = self.program
+        arg0 = line.split(" ")[0]
+        args = line[len(arg0)+1:].split(",")
+        if arg0 == "speed":
+            program.speed = Float32(float(args[0]))
+        elif arg0 == "memory":
+            if len(args) != 6:
+                self.Error("Incorrect number of arguments to memory: must be 6 (base,size,faddrparam,fvalueparam,breadparam,bwriteparam)")
+            params = [program.Operand(a) for a in args[2:]]
+            if any(p[0] != PARAM for p in params) or [program.params[p[1]][0] for p in params] != ["f", "f", "b", "b"]:
+                self.Error("Wrong parameter types to memory: must be float, float, bool, bool")
+            program.memories.append([int(args[0]), int(args[1])] + [p[1] for p in params])
+        elif arg0 == "macro":
+            self.macro = [args[0].strip(" \t"), [a.strip(" \t") for a in args[1:]], []]
+        elif arg0 == "layer":
+            self.layer = {"name": args[0].strip(" \t"), "states": []}
+        elif arg0 == "state":
+            if self.layer is None:
+                self.Error("state is only valid within a layer")
+            self.state = {"name": args[0].strip(" \t"), "tasks": [], "transitions": [], "after": None}
+        elif arg0 in ("goto_if", "goto_unless"):
+            if self.state is None:
+                self.Error(f"{arg0} is only valid within a state")
+            if len(args) != 2:
+                self.Error(f"{arg0} requires exactly 2 arguments")
+            condition = program.Operand(args[0])
+            if condition[0] != PARAM:
+                self.Error(f"{arg0} condition must be a parameter")
+            self.state["transitions"].append((condition[1], args[1].strip(" \t"), arg0 == "goto_unless"))
+        elif arg0 == "goto":
+            if self.state is None:
+                self.Error("goto is only valid within a state")
+            self.state["after"] = args[0].strip(" \t")
+        elif arg0 == "output":
+            if self.layer is not None:
+                self.Error("output is only valid outside of a layer")
+            if len(args) != 2 and len(args) != 3:
+                self.Error("output requires exactly 2 or 3 arguments")
+            param = program.Operand(args[0])
+            if param[0] != PARAM:
+                self.Error("output must be a parameter")
+            program.outputs.append((param[1], args[1].strip(" \t"), args[2].strip(" \t") if len(args) >= 3 else None))
+        elif arg0 == "var":
+            v = program.Operand(args[0])
+            if v[0] != PARAM:
+                self.Error("Variable name cannot be a number or boolean")
+            program.declared[v[1]] = True
+        elif arg0 == "end":
+            if args[0] == "layer":
+                if self.layer is None:
+                    self.Error("end layer outside of a layer")
+                program.layers.append(self.layer)
+                self.layer = None
+            elif args[0] == "state":
+                if self.state is None:
+                    self.Error("end state outside of a state")
+                self.layer["states"].append(self.state)
+                self.state = None
+            elif args[0] != "macro":
+                self.Error(f"Unknown end argument: {args[0]}")
+        elif arg0 in OPCODE_BYTES:
+            if self.state is None:
+                self.Error("Instructions are only valid within a state")
+            if len(args) != Arity(arg0):
+                self.Error(f"Incorrect number of arguments to operator {arg0}: should be {Arity(arg0)}")
+            operands = [program.Operand(a) for a in args]
+            if operands[0][0] != PARAM:
+                self.Error(f"Cannot assign to a constant: {args[0]}")
+            self.state["tasks"].append((arg0, operands))
+        elif arg0 in self.macros:
+            names, contents = self.macros[arg0]
+            # replace macro parameters with arguments verbatim, like the assembler
+            insert = "\n".join(contents)
+            for j in range(len(names)):
+                insert = insert.replace(names[j], args[j] if j < len(args) else "")
+            for expanded in insert.split("\n"):
+                self.Line(expanded)
+        else:
+            self.Error(f"Unknown opcode: {arg0}")
+
+    def Resolve(self):
+        """ Replaces state names in gotos by their index in the layer """
+        for layer in self.program.layers:
+            index = {state["name"]: i for i, state in enumerate(layer["states"])}
+            for state in layer["states"]:
+                for dest in [t[1] for t in state["transitions"]] + ([state["after"]] if state["after"] is not None else []):
+                    if dest not in index:
+                        raise IRError(f"Animator state {dest} is undefined in layer {layer['name']}")
+                state["transitions"] = [(param, index[dest], unless) for param, dest, unless in state["transitions"]]
+                if state["after"] is not None:
+                    state["after"] = index[state["after"]]
+
+
+class IRWriter:
+    def __init__(self, f):
+        self.f = f
+        self.buffer = bytearray()
+        self.strings = {}
+
+    def Varint(self, v: int):
+        while v >= 0x80:
+            self.buffer.append((v & 0x7f) | 0x80)
+            v >>= 7
+        self.buffer.append(v)
+
+    def String(self, s: str):
+        self.Varint(self.strings[s])
+
+    def Flush(self):
+        self.f.write(self.buffer)
+        self.buffer = bytearray()
+
+    def Intern(self, program: Program) -> list:
+        strings = []
+        def add(s):
+            if s not in self.strings:
+                self.strings[s] = len(strings)
+                strings.append(s)
+        for kind, name in program.params:
+            add(name)
+        for param, obj, path in program.outputs:
+            add(obj)
+            if path is not None:
+                add(path)
+        for layer in program.layers:
+            add(layer["name"])
+            for state in layer["states"]:
+                add(state["name"])
+        return strings
+
+    def Operand(self, operand):
+        kind, value = operand
+        self.buffer.append(kind)
+        if kind == PARAM:
+            self.Varint(value)
+        elif kind == INT:
+            self.buffer += struct.pack("<i", value)
+        elif kind == FLOAT:
+            self.buffer += struct.pack("<f", value)
+        else:
+            self.buffer.append(1 if value else 0)
+
+    def Write(self, program: Program):
+        self.buffer += MAGIC
+        self.buffer.append(VERSION)
+        if program.speed is None:
+            self.buffer.append(0)
+        else:
+            self.buffer.append(1)
+            self.buffer += struct.pack("<f", program.speed)
+        strings = self.Intern(program)
+        self.Varint(len(strings))
+        for s in strings:
+            data = s.encode("utf-8")
+            self.Varint(len(data))
+            self.buffer += data
+        self.Varint(len(program.params))
+        for i, (kind, name) in enumerate(program.params):
+            self.buffer.append(ord(kind))
+            self.String(name)
+            self.buffer.append(1 if program.declared[i] else 0)
+        self.Varint(len(program.outputs))
+        for param, obj, path in program.outputs:
+            self.Varint(param)
+            self.String(obj)
+            self.Varint(0 if path is None else self.strings[path] + 1)
+        self.Varint(len(program.memories))
+        for mem in program.memories:
+            self.buffer += struct.pack("<ii", mem[0], mem[1])
+            for param in mem[2:]:
+                self.Varint(param)
+        self.Varint(len(program.layers))
+        for layer in program.layers:
+            self.String(layer["name"])
+            self.Varint(len(layer["states"]))
+            for state in layer["states"]:
+                self.String(state["name"])
+                self.Varint(len(state["tasks"]))
+                for op, operands in state["tasks"]:
+                    self.buffer.append(OPCODE_BYTES[op])
+                    for operand in operands:
+                        self.Operand(operand)
+                self.Varint(len(state["transitions"]))
+                for param, dest, unless in state["transitions"]:
+                    self.buffer.append(1 if unless else 0)
+                    self.Varint(param)
+                    self.Varint(dest)
+                self.Varint(0 if state["after"] is None else state["after"] + 1)
+            self.Flush()
+        self.Flush()
+
+
+class IRReader:
+    def __init__(self, f):
+        self.data = f.read()
+        self.pos = 0
+        self.strings = []
+
+    def Byte(self) -> int:
+        if self.pos >= len(self.data):
+            raise IRError("Unexpected end of binary IR")
+        self.pos += 1
+        return self.data[self.pos-1]
+
+    def Varint(self) -> int:
+        v = 0
+        shift = 0
+        while True:
+            b = self.Byte()
+            v |= (b & 0x7f) << shift
+            if b < 0x80:
+                return v
+            shift += 7
+
+    def Unpack(self, fmt: str):
+        size = struct.calcsize(fmt)
+        if self.pos + size > len(self.data):
+            raise IRError("Unexpected end of binary IR")
+        values = struct.unpack_from(fmt, self.data, self.pos)
+        self.pos += size
+        return values
+
+    def String(self) -> str:
+        return self.strings[self.Varint()]
+
+    def Operand(self):
+        kind = self.Byte()
+        if kind == PARAM:
+            return (PARAM, self.Varint())
+        if kind == INT:
+            return (INT, self.Unpack("<i")[0])
+        if kind == FLOAT:
+            return (FLOAT, self.Unpack("<f")[0])
+        if kind == BOOL:
+            return (BOOL, self.Byte() != 0)
+        raise IRError(f"Unknown operand kind {kind}")
+
+    def Read(self) -> Program:
+        if self.data[:4] != MAGIC:
+            raise IRError("Not a binary IR file")
+        self.pos = 4
+        version = self.Byte()
+        if version != VERSION:
+            raise IRError(f"Unsupported binary IR version {version}")
+        program = Program()
+        if self.Byte():
+            program.speed = self.Unpack("<f")[0]
+        for i in range(self.Varint()):
+            length = self.Varint()
+            self.strings.append(self.data[self.pos:self.pos+length].decode("utf-8"))
+            self.pos += length
+        for i in range(self.Varint()):
+            kind = chr(self.Byte())
+            program.Param(kind, self.String())
+            program.declared[i] = self.Byte() != 0
+        for i in range(self.Varint()):
+            param = self.Varint()
+            obj = self.String()
+            path = self.Varint()
+            program.outputs.append((param, obj, self.strings[path-1] if path else None))
+        for i in range(self.Varint()):
+            program.memories.append(list(self.Unpack("<ii")) + [self.Varint() for j in range(4)])
+        for i in range(self.Varint()):
+            layer = {"name": self.String(), "states": []}
+            for j in range(self.Varint()):
+                state = {"name": self.String(), "tasks": [], "transitions": [], "after": None}
+                for k in range(self.Varint()):
+                    opcode = self.Byte()
+                    if opcode >= len(OPCODES):
+                        raise IRError(f"Unknown opcode {opcode}")
+                    op = OPCODES[opcode]
+                    state["tasks"].append((op, [self.Operand() for n in range(Arity(op))]))
+                for k in range(self.Varint()):
+                    unless = self.Byte() != 0
+                    param = self.Varint()
+                    state["transitions"].append((param, self.Varint(), unless))
+                after = self.Varint()
+                state["after"] = after - 1 if after else None
+                layer["states"].append(state)
+            program.layers.append(layer)
+        return program
+
+
+def CheckRoundTrip(text: str) -> bytes:
+    """ Checks that text, its binary form and the text written back from it all read as the same Program.
+    Returns the binary form. """
+    import io
+    program = Program.FromText(text)
+    out = io.BytesIO()
+    IRWriter(out).Write(program)
+    data = out.getvalue()
+    read = IRReader(io.BytesIO(data)).Read()
+    if read != program:
+        raise IRError("Binary IR does not read back as the same program")
+    if Program.FromText(read.ToText()) != program:
+        raise IRError("Text written from binary IR does not read back as the same program")
+    return data
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print(f"Usage: {sys.argv[0]} program.asm [-o program.c2ir] [--check] | program.c2ir --text")
+        exit(0)
+
+    ifile = sys.argv[1]
+    ofile = None
+    check = False
+    text = False
+    for i in range(2, len(sys.argv)):
+        if sys.argv[i] == "-o" and i+1 < len(sys.argv):
+            ofile = sys.argv[i+1]
+        elif sys.argv[i] == "--check":
+            check = True
+        elif sys.argv[i] == "--text":
+            text = True
+
+    if text:
+        with open(ifile, "rb") as f:
+            program = IRReader(f).Read()
+        print(program.ToText())
+        exit(0)
+    with open(ifile) as f:
+        source = f.read()
+    if check:
+        data = CheckRoundTrip(source)
+        print(f"Round trip OK: {len(source.encode('utf-8'))} bytes of text, {len(data)} bytes of binary IR")
+    if ofile is not None or not check:
+        program = Program.FromText(source)
+        with open(ofile or ifile + ".c2ir", "wb") as f:
+            IRWriter(f).Write(program)
@@ -0,0 +1,117 @@
+import os, time, hashlib
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".c2animcvr_cache")
+
+
+class BuildCache:
+    """ Content addressed on-disk cache of generated assembly.
+    Entries are evicted when they have not been used for max_age seconds, then oldest first until the cache fits in max_bytes. """
+    def __init__(self, path: str = DEFAULT_CACHE_DIR, max_bytes: int = 64*1024*1024, max_age: float = 30*24*60*60):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+
+    def Key(self, source: str, version: str, *options) -> str:
+        h = hashlib.sha256()
+        for part in (version, *options):
+            h.update(str(part).encode("utf-8"))
+            h.update(b"\0")
+        h.update(source.encode("utf-8"))
+        return h.hexdigest()
+
+    def EntryPath(self, key: str) -> str:
+        return os.path.join(self.path, key + ".asm")
+
+    def Get(self, key: str):
+        path = self.EntryPath(key)
+        try:
+            with open(path) as f:
+                data = f.read()
+        except OSError:
+            self.misses += 1
+            return None
+        # entries age from their last use
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        self.hits += 1
+        return data
+
+    def Put(self, key: str, data: str):
+        self.Write(self.EntryPath(key), data)
+        self.Evict()
+
+    def PutFile(self, key: str, source_path: str):
+        """ Puts a copy of the file at source_path, without reading it into memory """
+        import shutil
+        os.makedirs(self.path, exist_ok=True)
+        path = self.EntryPath(key)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        shutil.copyfile(source_path, tmp)
+        os.replace(tmp, path)
+        self.Evict()
+
+    def Write(self, path: str, data: str):
+        os.makedirs(self.path, exist_ok=True)
+        # write to a temporary file first so concurrent builds never read a partial entry
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def StatesPath(self, source_path: str) -> str:
+        name = hashlib.sha256(os.path.abspath(source_path).encode("utf-8")).hexdigest()
+        return os.path.join(self.path, name + ".states.json")
+
+    def GetStates(self, source_path: str, version: str) -> dict:
+        """ Returns the fingerprint:instructions of the states from the last build of source_path """
+        import json
+        try:
+            with open(self.StatesPath(source_path)) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if data.get("version") != version:
+            return {}
+        return data.get("states", {})
+
+    def PutStates(self, source_path: str, version: str, states: dict):
+        import json
+        self.Write(self.StatesPath(source_path), json.dumps({"version": version, "states": states}))
+
+    def Evict(self):
+        now = time.time()
+        entries = []
+        total = 0
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            return
+        for name in names:
+            if not name.endswith(".asm") and not name.endswith(".json"):
+                continue
+            path = os.path.join(self.path, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if now - st.st_mtime > self.max_age:
+                self.Remove(path)
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            self.Remove(path)
+            total -= size
+
+    def Remove(self, path: str):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -1,6 +1,206 @@
-import os, sys, json
+import os, sys, math, time, struct
+from collections import OrderedDict
 from py_expression_eval import *
 
+VERSION = "0.2"
+
+# operations whose arguments can be swapped, and operations that must run every time
+COMMUTATIVE_OPS = ("add", "mul", "eq", "ne", "land", "lor", "and", "or", "xor", "min", "max")
+IMPURE_OPS = ("random", "diceroll")
+# operations that are a single AnimatorDriver task, the BUILTINS below are expanded into them
+DRIVER_OPS = ("set", "add", "sub", "mul", "div", "mod", "pow", "log", "eq", "ne", "lt", "le", "gt", "ge", "ip", "fp",
+              "land", "lor", "and", "or", "xor", "shl", "shr", "rol", "ror", "cond")
+
+def _shr(a, b):
+    return int(a)//(2**int(b))
+
+def _shl(a, b):
+    return int(a)*(2**int(b))
+
+def _ror(a, b):
+    return ((int(a) & 0xffffffff) >> (int(b) % 32) | int(a) << (32 - int(b) % 32)) & 0xffffffff
+
+def _rol(a, b):
+    return (int(a) << (int(b) % 32) | (int(a) & 0xffffffff) >> (32 - int(b) % 32)) & 0xffffffff
+
+def _band(a, b):
+    return int(a)&int(b)
+
+def _bor(a, b):
+    return int(a)|int(b)
+
+def _bxor(a, b):
+    return int(a)^int(b)
+
+def _round(a):
+    return math.copysign(math.floor(abs(a) + 0.5), a)
+
+def _float32(v):
+    """ Returns v rounded to the float the animator holds, as v itself when it holds it exactly so it prints the same """
+    try:
+        f = struct.unpack("f", struct.pack("f", v))[0]
+    except OverflowError:
+        f = math.copysign(math.inf, v)
+    if f == v:
+        return v
+    return int(f) if type(v) is int and math.isfinite(f) else f
+
+# functions added to the parser's values, so they can be called and folded
+BITWISE_FUNCTIONS = {
+    "shift_right": _shr, "shr": _shr,
+    "shift_left": _shl, "shl": _shl,
+    "rotate_right": _ror, "ror": _ror,
+    "rotate_left": _rol, "rol": _rol,
+    "bitwise_and": _band, "band": _band,
+    "bitwise_or": _bor, "bor": _bor,
+    "bitwise_xor": _bxor, "bxor": _bxor,
+}
+
+# fold the way AnimatorDriver evaluates: conditions are true at >= 0.5, logic operators give 0 or 1,
+# the remainder takes the sign of the dividend and the builtins run as the tasks they are expanded into
+FOLD_OPS2 = {
+    "and": lambda a,b: int(a >= 0.5 and b >= 0.5),
+    "or": lambda a,b: int(a >= 0.5 or b >= 0.5),
+    "%": math.fmod,
+}
+FOLD_FUNCTIONS = {
+    "if": lambda a,b,c: b if a >= 0.5 else c,
+    "round": _round,
+}
+FOLD_OPS1 = {
+    "round": _round,
+    "sqrt": lambda a: math.pow(a, 0.5),
+    "exp": lambda a: math.pow(_float32(math.e), a),
+}
+
+OPERATOR_MAP = {
+    'sqrt': "sqrt",
+    'abs': "abs",
+    'ceil': "ceil",
+    'floor': "floor",
+    'round': "round",
+    'not': "not",
+    'exp': "exp",
+    '+': "add",
+    '-': "sub",
+    '*': "mul",
+    '/': "div",
+    '%': "mod",
+    '^': "pow",
+    '**': "pow",
+    "==": "eq",
+    "!=": "ne",
+    ">": "gt",
+    "<": "lt",
+    ">=": "ge",
+    "<=": "le",
+    "and": "land",
+    "or": "lor",
+    "xor": "xor",
+    "D": "diceroll",
+    'random': "random",
+    'log': "log",
+    'min': "min",
+    'max': "max",
+    'pow': "pow",
+    'if': "cond",
+    'band': "and",
+    'bor': "or",
+    'bxor': "xor",
+    'shr': "shr",
+    'shl': "shl",
+    'ror': "ror",
+    'rol': "rol",
+    'bitwise_and': "and",
+    'bitwise_or': "or",
+    'bitwise_xor': "xor",
+    'shift_right': "shr",
+    'shift_left': "shl",
+    'rotate_right': "ror",
+    'rotate_left': "rol",
+}
+
+# the builtins the compiler expands into driver tasks, $A is the destination, $B and $C the arguments
+# and $T0... fresh temporaries each written once. Only the last task writes $A, so $A may be one of the arguments.
+BUILTINS = {
+    "negate": (("sub", "$A", "0", "$B"),),
+    "sqrt": (("pow", "$A", "$B", "0.5"),),
+    "exp": (("pow", "$A", str(math.e), "$B"),),
+    "not": (("xor", "$A", "$B", "0xffffffff"),),
+    "abs": (
+        ("lt", "$T0", "$B", "0"),
+        ("sub", "$T1", "0", "$B"),
+        ("cond", "$A", "$T0", "$T1", "$B"),
+    ),
+    # ip truncates toward zero, so negative numbers with a fraction are one too high
+    "floor": (
+        ("fp", "$T0", "$B"),
+        ("lt", "$T1", "$T0", "0"),
+        ("ip", "$T2", "$B"),
+        ("sub", "$A", "$T2", "$T1"),
+    ),
+    "ceil": (
+        ("fp", "$T0", "$B"),
+        ("gt", "$T1", "$T0", "0"),
+        ("ip", "$T2", "$B"),
+        ("add", "$A", "$T2", "$T1"),
+    ),
+    # halves round away from zero
+    "round": (
+        ("lt", "$T0", "$B", "0"),
+        ("cond", "$T1", "$T0", "-0.5", "0.5"),
+        ("add", "$T2", "$B", "$T1"),
+        ("ip", "$A", "$T2"),
+    ),
+    "min": (
+        ("lt", "$T0", "$B", "$C"),
+        ("cond", "$A", "$T0", "$B", "$C"),
+    ),
+    "max": (
+        ("gt", "$T0", "$B", "$C"),
+        ("cond", "$A", "$T0", "$B", "$C"),
+    ),
+}
+
+# the rewrites ReduceTree may apply, with the driver tasks of the operation before and after.
+# A rewrite is only ever applied if it does not add tasks.
+STRENGTH_REDUCTIONS = {
+    "pow_zero": (1, 0),         # pow(x, 0) -> 1
+    "pow_one": (1, 0),          # pow(x, 1) -> x
+    "pow_two": (1, 1),          # pow(x, 2) -> x*x, exact where pow is not
+    "mul_one": (1, 0),          # x*1 -> x
+    "div_one": (1, 0),          # x/1 -> x
+    "div_power_of_two": (1, 1), # x/2^k -> x*2^-k, exact
+    "add_zero": (1, 0),         # x+0 -> x
+    "sub_zero": (1, 0),         # x-0 -> x
+    "shift_zero": (1, 0),       # shl(x, 0), shr(x, 0) -> x for integer x
+    "shl_constant": (1, 1),     # shl(x, k) -> x*2^k for integer x
+}
+# operations whose result is always an integer
+INTEGER_OPS = ("and", "or", "xor", "shl", "shr", "rol", "ror", "floor", "ceil", "round")
+
+# driver tasks an unrolled loop may take when no tasks per state limit is given,
+# and the most iterations LowerLoops works out for a loop before it gives up on it
+UNROLL_TASKS = 256
+UNROLL_TRIPS = 4096
+
+_compiler_version = None
+def CompilerVersion() -> str:
+    """ VERSION plus a digest of the compiler's own sources, so that editing the compiler invalidates cached builds """
+    global _compiler_version
+    if _compiler_version is None:
+        import hashlib, py_expression_eval
+        h = hashlib.sha256()
+        for path in (__file__, py_expression_eval.__file__):
+            with open(path, "rb") as f:
+                h.update(f.read())
+        _compiler_version = f"{VERSION}+{h.hexdigest()[:16]}"
+    return _compiler_version
+
+class CompileError(RuntimeError):
+    pass
+
+
 class Struct:
     """ members is a str:str dictionary where the values are single-letter type names """
     def __init__(self, name: str, members: dict):
@@ -16,8 +216,61 @@ class Struct:
         raise NotImplementedError()
 
 
+class ParseCache:
+    """ LRU cache of parsed expressions keyed by their normalized text.
+    Token sequences are stored as tuples and shared between the returned Expressions,
+    so callers must replace Expression.tokens rather than mutate it. """
+    def __init__(self, parser: Parser = None, maxsize: int = 4096):
+        self.parser = parser or Parser()
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def Normalize(self, expr: str) -> str:
+        key = expr.strip(" \t\n")
+        # trailing whitespace is significant after word operators such as "or "
+        if len(key) and key[-1].isalpha():
+            return expr.lstrip(" \t\n")
+        return key
+
+    def Parse(self, expr: str) -> Expression:
+        key = self.Normalize(expr)
+        tokens = self.entries.get(key)
+        if tokens is None:
+            self.misses += 1
+            tokens = tuple(self.parser.parse(key).tokens)
+            self.entries[key] = tokens
+            if len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return Expression(tokens, self.parser.ops1, self.parser.ops2, self.parser.functions)
+
+
+class ValueTable:
+    """ The results computed so far in a state, for common subexpression elimination.
+    results maps (op, args...) to the name of the parameter holding it, entries are dropped once that parameter or an argument is written. """
+    def __init__(self):
+        self.results = {}
+        # parameter:keys of the results that mention it
+        self.uses = {}
+
+    def Put(self, key: tuple, name: str):
+        self.results[key] = name
+        for param in ("f"+name, *key[1:]):
+            self.uses.setdefault(param, set()).add(key)
+
+    def Clobber(self, param: str):
+        """ Forgets the results held in param and the results computed from it """
+        for key in self.uses.pop(param, ()):
+            self.results.pop(key, None)
+
+
 class Compiler:
-    def __init__(self, source: str, debug: bool = False):
+    def __init__(self, source: str, debug: bool = False, parse_cache: ParseCache = None, state_cache: dict = None,
+                 optimize: bool = True, max_state_tasks: int = None):
         self.debug = debug
         self.source = source
         self.debug_tokens = []
@@ -28,60 +281,59 @@ class Compiler:
         self.anon_label_count = 0
         self.assembly = []
         self.lineno = 0
-        self.parser = parser = Parser()
+        self.column = 0
+        self.statements = []
+        self.positions = []
+        self.parse_cache = parse_cache or ParseCache()
+        # fingerprint:instructions of states from a previous build, and of the states built by this one
+        self.state_cache = state_cache or {}
+        self.states_built = {}
+        self.rebuilt_states = []
+        # number of virtual temporaries handed out, and of #T parameters needed to hold them
+        self.virtual_temps = 0
+        self.removed_states = 0
+        # rewrite name:number of times ReduceTree applied it, and the driver tasks that saved
+        self.reductions = {}
+        self.reduced_tasks = 0
+        # source line each label was created on
+        self.label_lines = {"entry": 1}
+        self.temps = 0
+        self.parser = parser = self.parse_cache.parser
+        self.optimize = optimize
+        # most driver tasks a state may run, longer states are split over several frames
+        if max_state_tasks is not None and max_state_tasks < 1:
+            raise ValueError("max_state_tasks must be at least 1")
+        self.max_state_tasks = max_state_tasks
+        self.unrolled_loops = 0
+        self.split_states = 0
+        # pass of Compile:seconds spent in it
+        self.phase_times = {}
         self.structs = {}
-        parser.values["shift_right"] = parser.values["shr"] = lambda a,b: int(a)//(2**int(b))
-        parser.values["shift_left"] = parser.values["shl"] = lambda a,b: int(a)*(2**int(b))
-        parser.values["rotate_right"] = parser.values["ror"] = lambda a,b: int(a)//(2**int(b)) + int(a)*(2**int(31 - b))
-        parser.values["rotate_left"] = parser.values["rol"] = lambda a,b: int(a)*(2**int(b)) + int(a)//(2**int(31 - b))
-        parser.values["bitwise_and"] = parser.values["band"] = lambda a,b: int(a)&int(b)
-        parser.values["bitwise_or"] = parser.values["bor"] = lambda a,b: int(a)|int(b)
-        parser.values["bitwise_xor"] = parser.values["bxor"] = lambda a,b: int(a)^int(b)
-        self.builtins_assembly = [
-            "var f#BuiltinTmp",
-            "var f#BuiltinTmpA",
-            "macro sqrt, $A, $B",
-            "  pow $A, $B, -1",
-            "end macro",
-            "macro ceil, $A, $B",
-            "  fpart f#BuiltinTmp, $B",
-            "  ipart $A, $B",
-            "  cond f#BuiltinTmp, f#BuiltinTmp, 0, 1",
-            "  add $A, $A, f#BuiltinTmp",
-            "end macro",
-            "; note: AnimatorDriver conditional is true if the condition is >= 0.5.",
-            "macro round, $A, $B",
-            "  fpart f#BuiltinTmp, $B",
-            "  ipart $A, $B",
-            "  cond f#BuiltinTmp, f#BuiltinTmp, 0, -1",
-            "  add $A, $A, f#BuiltinTmp",
-            "end macro",
-            "macro abs, $A, $B",
-            "  negate $A, $B",
-            "  ge f#BuiltinTmp, $A, 0",
-            "  cond $A, f#BuiltinTmp, $B, $A",
-            "end macro",
-            "macro negate, $A, $B",
-            "  sub $A, 1, $B",
-            "end macro",
-            "macro not, $A, $B",
-            "  xor $A, $B, 0xffffffff",
-            "end macro",
-        ]
+        # name:size of the declared arrays, and the number of array reads hoisted out of the current statement
+        self.arrays = {}
+        self.loads = 0
+        parser.values.update(BITWISE_FUNCTIONS)
+        parser.ops2.update(FOLD_OPS2)
+        parser.ops1.update(FOLD_OPS1)
+        parser.functions.update(FOLD_FUNCTIONS)
 
     def InternalError(self, m="Unknown"):
         print(f"Internal Error: {m}")
-        raise RuntimeError(f"Internal Error: {m}")
+        raise CompileError(f"Internal Error: {m}")
 
     def Error(self, m="Syntax"):
-        print(f"Error on line {self.lineno}: {m}")
-        raise RuntimeError(f"Error: {m}")
+        print(f"Error on line {self.lineno}, column {self.column}: {m}")
+        raise CompileError(f"Error on line {self.lineno}, column {self.column}: {m}")
 
     def Finalize(self):
+        self.WriteDebugTokens()
+        return "\n".join(self.assembly)
+
+    def WriteDebugTokens(self):
         if self.debug:
+            import json
             with open("debug_tokens.json", "w") as f:
                 json.dump(self.debug_tokens, f)
-        return "\n".join(self.assembly)
 
     def serialize(self, v):
         if type(v) is Token:
@@ -101,55 +353,7 @@ class Compiler:
         return v
 
     def SymbolToOperator(self, sym: str) -> str:
-        operatormap = {
-            'sqrt': "sqrt",
-            'abs': "abs",
-            'ceil': "ceil",
-            'floor': "ipart",
-            'round': "round",
-            'not': "not",
-            'exp': "pow",
-            '+': "add",
-            '-': "sub",
-            '*': "mul",
-            '/': "div",
-            '%': "mod",
-            '^': "pow",
-            '**': "pow",
-            "==": "eq",
-            "!=": "ne",
-            ">": "gt",
-            "<": "lt",
-            ">=": "ge",
-            "<=": "le",
-            "and": "land",
-            "or": "lor",
-            "xor": "xor",
-            "D": "diceroll",
-            'random': "random",
-            'log': "log",
-            'min': "min",
-            'max': "max",
-            'pow': "pow",
-            'if': "cond",
-            'band': "and",
-            'bor': "or",
-            'bxor': "xor",
-            'shr': "shr",
-            'shl': "shl",
-            'ror': "ror",
-            'rol': "rol",
-            'bitwise_and': "and",
-            'bitwise_or': "or",
-            'bitwise_xor': "xor",
-            'shift_right': "shr",
-            'shift_left': "shl",
-            'rotate_right': "ror",
-            'rotate_left': "rol",
-        }
-        if sym in operatormap:
-            return operatormap[sym]
-        return ""
+        return OPERATOR_MAP.get(sym, "")
 
     def TokenToArg(self, t):
         if type(t) is not Token:
@@ -161,116 +365,114 @@ class Compiler:
         self.InternalError(f"Unexpected Token used as Argument: {t.toString()}")
 
     def BuildAssembly(self):
-        self.assembly.extend(self.builtins_assembly)
+        self.assembly.extend(self.IterAssembly())
 
+    def WriteAssembly(self, f):
+        """ Writes the assembly to the file-like f one line at a time, without building it in memory.
+        Writes the same text Finalize returns. """
+        self.WriteDebugTokens()
+        lines = self.IterAssembly()
+        for line in lines:
+            f.write(line)
+            break
+        for line in lines:
+            f.write("\n")
+            f.write(line)
+
+    def IterAssembly(self):
+        """ Yields the lines of assembly for the compiled layers """
         for var in self.vars.keys():
             if not self.vars[var]["constant"]:
-                self.assembly.append(f"var f{var}")
+                yield f"var f{var}"
+
+        for n in range(self.temps):
+            yield f"var f#T{n}"
 
         for opt in self.outputters:
-            self.assembly.append(f"output f{opt['var']}, {','.join(opt['dest'])}")
+            yield f"output f{opt['var']}, {','.join(opt['dest'])}"
 
         for layer in self.layers:
             if "name" in layer:
-                self.assembly.append(f"layer {layer['name']}")
+                yield f"layer {layer['name']}"
                 if "states" in layer:
                     for statename in layer["states"].keys():
                         state = layer["states"][statename]
-                        self.assembly.append(f"state {statename}")
+                        yield f"state {statename}"
                         for instr in state["instructions"]:
-                            self.assembly.append(instr)
+                            yield self.FormatInstruction(instr)
                         for goto in state["gotos"]:
                             if "condition" in goto:
                                 if goto["unless"]:
-                                    self.assembly.append(f"goto_unless {goto['condition']}, {goto['state']}")
+                                    yield f"goto_unless {goto['condition']}, {goto['state']}"
                                 else:
-                                    self.assembly.append(f"goto_if {goto['condition']}, {goto['state']}")
+                                    yield f"goto_if {goto['condition']}, {goto['state']}"
                             else:
-                                self.assembly.append(f"goto {goto['state']}")
-                        self.assembly.append(f"end state")
-                self.assembly.append(f"end layer")
+                                yield f"goto {goto['state']}"
+                        yield f"end state"
+                yield f"end layer"
+
+    def Label(self, parsed: list, name: str):
+        self.label_lines[name] = self.lineno
+        parsed.append(["@LABEL", name])
 
-    def _Compile(self, source, parsed, depth=0, withinif=False):
-        ln = 0
+    def _Compile(self, ln, parsed, depth=0, withinif=False):
+        """ Compiles self.statements starting at index ln into parsed.
+        Returns the index following the closing "end" of the block, or the number of statements. """
+        source = self.statements
         while ln < len(source):
             line = source[ln]
+            self.lineno, self.column = self.positions[ln]
             ln += 1
+            self.loads = 0
             line = line.strip(" \n\t")
-            self.lineno += 1
             if line.startswith("label "):
                 name = "L"+line.split(" ", maxsplit=1)[1]
                 self.labels.append(name)
-                parsed.append(["@LABEL", name])
+                self.Label(parsed, name)
             elif line.startswith("goto "):
                 name = "L"+line.split(" ", maxsplit=1)[1]
                 if name not in self.labels:
-                    self.Error("Unknown label \"{name}\"")
+                    self.Error(f"Unknown label \"{name}\"")
                 parsed.append(["@GOTO", name])
             elif line.startswith("end"):
                 if depth <= 0:
                     self.Error("Unexpected \"end\"")
                 return ln
             elif line.startswith("if "):
-                cond = line.split(" ", maxsplit=1)[1].replace("[","(").replace("]",")")
+                cond = line.split(" ", maxsplit=1)[1]
                 var = f"#I{depth}"
-                parsed.append([var, self.parser.parse(cond)])
+                parsed.append([var, self.ParseExpr(parsed, cond)])
                 inner = []
                 innerElse = []
                 # compile if block
-                ln += self._Compile(source[ln:], inner, depth+1)
-                if source[ln].startswith("else"):
+                ln = self._Compile(ln, inner, depth+1)
+                # the whole keyword, so statements like "elsewhere = 1" are not taken for it
+                if ln < len(source) and source[ln].strip(" \n\t").split(maxsplit=1)[:1] == ["else"]:
                     ln += 1
                     # compile else block
-                    ln += self._Compile(source[ln:], innerElse, depth+1)
+                    ln = self._Compile(ln, innerElse, depth+1)
+                # the lines of loops in the blocks need their conditions too
+                inner = self.LowerLoops(inner)
+                innerElse = self.LowerLoops(innerElse)
                 iback = []
-                # setup if block ternary expressions
+                # setup if block ternary expressions, line = if(cond, expr, line)
+                # tokens may be shared with the parse cache, always build a new sequence
                 for line in inner:
+                    # array stores are lowered later, they keep the conditions to apply
+                    if line[0] == "@STORE":
+                        line[4].append((var, False))
                     if line[0].startswith("@"):
                         continue
-                    if len(line[1].tokens) > 1:
-                        line[1].tokens.extend([
-                            Token(TVAR, 'if', 0, 0),
-                            Token(TVAR, var, 0, 0),
-                            Token(TVAR, "#BuiltinTmpA", 0, 0),
-                            Token(TOP2, ',', 0, 0),
-                            Token(TVAR, line[0], 0, 0),
-                            Token(TOP2, ',', 0, 0),
-                            Token(TFUNCALL, 0, 0, 0),
-                        ])
-                    elif len(line[1].tokens) > 0:
-                        line[1].tokens = [
-                            Token(TVAR, 'if', 0, 0),
-                            Token(TVAR, var, 0, 0),
-                            line[1].tokens[0],
-                            Token(TOP2, ',', 0, 0),
-                            Token(TVAR, line[0], 0, 0),
-                            Token(TOP2, ',', 0, 0),
-                            Token(TFUNCALL, 0, 0, 0),
-                        ]
-                # setup else block ternary expressions
+                    if len(line[1].tokens) > 0:
+                        line[1].tokens = self.IfTokens(var, tuple(line[1].tokens), (Token(TVAR, line[0], 0, 0),))
+                # setup else block ternary expressions, line = if(cond, line, expr)
                 for line in innerElse:
+                    if line[0] == "@STORE":
+                        line[4].append((var, True))
                     if line[0].startswith("@"):
                         continue
-                    if len(line[1].tokens) > 1:
-                        line[1].tokens.extend([
-                            Token(TVAR, 'if', 0, 0),
-                            Token(TVAR, var, 0, 0),
-                            Token(TVAR, line[0], 0, 0),
-                            Token(TOP2, ',', 0, 0),
-                            Token(TVAR, "#BuiltinTmpA", 0, 0),
-                            Token(TOP2, ',', 0, 0),
-                            Token(TFUNCALL, 0, 0, 0),
-                        ])
-                    elif len(line[1].tokens) > 0:
-                        line[1].tokens = [
-                            Token(TVAR, 'if', 0, 0),
-                            Token(TVAR, var, 0, 0),
-                            Token(TVAR, line[0], 0, 0),
-                            Token(TOP2, ',', 0, 0),
-                            line[1].tokens[0],
-                            Token(TOP2, ',', 0, 0),
-                            Token(TFUNCALL, 0, 0, 0),
-                        ]
+                    if len(line[1].tokens) > 0:
+                        line[1].tokens = self.IfTokens(var, (Token(TVAR, line[0], 0, 0),), tuple(line[1].tokens))
                 # backup original values of parameters touched by if/else blocks
                 for ib in iback:
                     parsed.append(["#IB"+ib, Expression([Token(TVAR, ib, 0, 0)], [], [], [])])
@@ -281,31 +483,30 @@ class Compiler:
             elif line.startswith("while "):
                 if withinif:
                     self.Error("Loops within if statements are not currently supported")
-                cond = line.split(" ", maxsplit=1)[1].replace("[","(").replace("]",")")
+                cond = line.split(" ", maxsplit=1)[1]
                 self.anon_label_count += 1
                 wlblname = f"W{self.anon_label_count}"
                 wlblnameLoop = f"W{self.anon_label_count}Loop"
                 wlblnameEnd = f"W{self.anon_label_count}End"
-                parsed.append(["@LABEL", wlblname])
+                self.Label(parsed, wlblname)
                 var = f"#W{depth}"
-                parsed.append([var, self.parser.parse(cond)])
+                parsed.append([var, self.ParseExpr(parsed, cond)])
                 parsed.append(["@GOTO_UNLESS", wlblnameEnd, "f"+var])
                 parsed.append(["@GOTO", wlblnameLoop])
-                parsed.append(["@LABEL", wlblnameLoop])
-                ln += self._Compile(source[ln:], parsed, depth+1)
+                self.Label(parsed, wlblnameLoop)
+                ln = self._Compile(ln, parsed, depth+1)
                 parsed.append(["@GOTO", wlblname])
-                parsed.append(["@LABEL", wlblnameEnd])
+                self.Label(parsed, wlblnameEnd)
             elif line.startswith("repeat "):
                 if withinif:
                     self.Error("Loops within if statements are not currently supported")
                 cond = line.split(" ", maxsplit=1)[1]
-                cond = cond.replace("[","(").replace("]",")")
                 self.anon_label_count += 1
                 wlblname = f"R{self.anon_label_count}"
-                parsed.append(["@LABEL", wlblname])
-                ln += self._Compile(source[ln:], parsed, depth+1)
+                self.Label(parsed, wlblname)
+                ln = self._Compile(ln, parsed, depth+1)
                 var = f"#R{depth}"
-                parsed.append([var, self.parser.parse(cond)])
+                parsed.append([var, self.ParseExpr(parsed, cond)])
                 parsed.append(["@GOTO", wlblname, "f"+var])
             elif line.startswith("for "):
                 if withinif:
@@ -323,27 +524,27 @@ class Compiler:
                     self.Error("Invalid for loop increment")
                 inc = [i.strip(" \t\n") for i in inc.split("=", maxsplit=1)]
                 ln += 1
-                var = f"#F{depth}"
                 self.anon_label_count += 1
-                wlblname = f"F{self.anon_label_count}"
-                wlblnameLoop = f"F{self.anon_label_count}Loop"
-                wlblnameEnd = f"F{self.anon_label_count}End"
-                parsed.append([init[0], self.parser.parse(init[1])])
-                parsed.append(["@LABEL", wlblname])
-                parsed.append([var, self.parser.parse(cond)])
-                parsed.append(["@GOTO_UNLESS", wlblnameEnd, "f"+var])
-                parsed.append(["@GOTO", wlblnameLoop])
-                parsed.append(["@LABEL", wlblnameLoop])
-                ln += self._Compile(source[ln:], parsed, depth+1)
-                parsed.append([inc[0], self.parser.parse(inc[1])])
-                parsed.append(["@GOTO", wlblname])
-                parsed.append(["@LABEL", wlblnameEnd])
+                number = self.anon_label_count
+                parsed.append([init[0], self.ParseExpr(parsed, init[1])])
+                begin = self.lineno
+                # array reads in the condition and the increment are hoisted into check and step
+                check = []
+                condition = self.ParseExpr(check, cond)
+                body = []
+                ln = self._Compile(ln, body, depth+1)
+                step = []
+                increment = self.ParseExpr(step, inc[1])
+                # LowerLoops turns this into labels and gotos, or unrolls it
+                parsed.append(["@FOR", number, init[0], f"#F{depth}", check, condition, body, step, inc[0], increment, begin, self.lineno])
             elif line.startswith("output "):
                 dest = "material._Value"
                 src = line.split(" ", maxsplit=1)[1]
                 if "->" in src:
                     src, dest = [a.strip(" \t\n") for a in src.split("->", maxsplit=1)]
                 parsed.append(["@OUTPUT", src, dest])
+            elif line.startswith("array "):
+                self.DeclareArray(line.split(" ", maxsplit=1)[1])
             # elif line.startswith("struct "):
             #     members = {}
             #     sname = line.split(" ", maxsplit=1)[1]
@@ -358,11 +559,454 @@ class Compiler:
             #     self.structs[sname] = Struct(sname, members)
             elif "=" in line:
                 var, expr = [a.strip(" \t\n") for a in line.split("=", maxsplit=1)]
-                expr = expr.replace("[","(").replace("]",")")
-                parsed.append([var, self.parser.parse(expr)])
+                if "[" in var:
+                    self.ParseStore(parsed, var, expr)
+                else:
+                    if var in self.arrays:
+                        self.Error(f"Array \"{var}\" must be indexed")
+                    parsed.append([var, self.ParseExpr(parsed, expr)])
         return len(source)
 
-    def _CompileExpr(self, line):
+    def IfTokens(self, condition: str, then: tuple, otherwise: tuple) -> tuple:
+        """ Postfix tokens of if(condition, then, otherwise) """
+        return (Token(TVAR, 'if', 0, 0), Token(TVAR, condition, 0, 0)) + then + (Token(TOP2, ',', 0, 0),) + otherwise + (
+            Token(TOP2, ',', 0, 0),
+            Token(TFUNCALL, 0, 0, 0),
+        )
+
+    def Expr(self, tokens) -> Expression:
+        return Expression(tuple(tokens), self.parser.ops1, self.parser.ops2, self.parser.functions)
+
+    def DeclareArray(self, decl: str):
+        """ Declares the array "name[size]", whose elements are the parameters name#0 to name#size-1 """
+        decl = decl.strip(" \t\n")
+        if "[" not in decl or not decl.endswith("]"):
+            self.Error("Invalid array declaration, expected \"array name[size]\"")
+        name, size = decl[:-1].split("[", maxsplit=1)
+        name = name.strip(" \t\n")
+        if not name.isidentifier() or name in self.parser.functions or name in Parser.LAZY_FUNCTIONS or name in self.parser.values:
+            self.Error(f"Invalid array name \"{name}\"")
+        if name in self.arrays:
+            self.Error(f"Array \"{name}\" is already declared")
+        try:
+            size = int(size)
+        except ValueError:
+            self.Error(f"Array size must be an integer: {size}")
+        if size < 1:
+            self.Error(f"Array size must be at least 1: {size}")
+        self.arrays[name] = size
+        for k in range(size):
+            self.vars[f"{name}#{k}"] = {"constant": False}
+
+    def ClampIndex(self, name: str, value) -> int:
+        """ The element of array name read for the index value, which is rounded down and clamped to the array """
+        if value != value:
+            return 0
+        return int(min(max(value, 0), self.arrays[name] - 1))
+
+    def ConstantIndex(self, name: str, index):
+        """ Returns the element of array name for the expression tree index if it is a constant, or else None """
+        index = self.FoldTree(index, {})
+        if self.arrays[name] == 1:
+            return 0
+        if not self.IsConstant(index):
+            return None
+        value = index[0].number_
+        if not 0 <= value < self.arrays[name]:
+            self.Error(f"Index {value} is out of range for array \"{name}\" of size {self.arrays[name]}")
+        return self.ClampIndex(name, value)
+
+    def ParseExpr(self, parsed: list, expr: str) -> Expression:
+        """ Parses expr, where a[i] reads element i of the array a.
+        Reads with a constant index become the element's parameter, the others are hoisted into
+        ["@LOAD", temp, array, index, line] lines appended to parsed and read from temp. """
+        expr = self.parse_cache.Parse(expr.replace("[","(").replace("]",")"))
+        if not any(t.type_ == TVAR and t.index_ in self.arrays for t in expr.tokens):
+            return expr
+        tree = self.ExprTree(expr.tokens)
+        if tree is None:
+            self.Error("Invalid expression")
+        def lower(node):
+            token, children = node
+            if token.type_ == TFUNCALL and children[0][0].type_ == TVAR and children[0][0].index_ in self.arrays:
+                name = children[0][0].index_
+                index = lower(children[1])
+                if index[0].type_ == TOP2 and index[0].index_ == ',':
+                    self.Error(f"Array \"{name}\" takes a single index")
+                k = self.ConstantIndex(name, index)
+                if k is not None:
+                    return (Token(TVAR, f"{name}#{k}", 0, 0), [])
+                temp = f"#L{self.loads}"
+                self.loads += 1
+                parsed.append(["@LOAD", temp, name, self.Expr(self.FlattenTree(index)), self.lineno])
+                return (Token(TVAR, temp, 0, 0), [])
+            if token.type_ == TVAR and token.index_ in self.arrays:
+                self.Error(f"Array \"{token.index_}\" must be indexed")
+            if token.type_ == TFUNCALL:
+                return (token, [children[0], lower(children[1])])
+            return (token, [lower(c) for c in children])
+        return self.Expr(self.FlattenTree(lower(tree)))
+
+    def ParseStore(self, parsed: list, target: str, expr: str):
+        """ Parses the assignment target = expr where target is "name[index]".
+        Stores with a constant index assign the element's parameter, the others become
+        ["@STORE", array, index, value, conditions, line] lines, conditions being the (if variable, in else) around them. """
+        if not target.endswith("]"):
+            self.Error(f"Invalid assignment target \"{target}\"")
+        name, index = target[:-1].split("[", maxsplit=1)
+        name = name.strip(" \t\n")
+        if name not in self.arrays:
+            self.Error(f"Unknown array \"{name}\"")
+        value = self.ParseExpr(parsed, expr)
+        index = self.ParseExpr(parsed, index)
+        tree = self.ExprTree(index.tokens)
+        if tree is None:
+            self.Error("Invalid array index")
+        k = self.ConstantIndex(name, tree)
+        if k is not None:
+            parsed.append([f"{name}#{k}", value])
+        else:
+            parsed.append(["@STORE", name, index, value, [], self.lineno])
+
+    def LowerArrays(self, parsed: list) -> list:
+        """ Replaces the "@LOAD" and "@STORE" lines of array accesses by direct parameter access when their index
+        is now constant, and otherwise by a binary tree of states over the index. Each level of the tree is a state
+        with one comparison task, so an access to an array of size n takes ceil(log2(n)) + 1 frames and as many tasks,
+        where the memory directive runs four tasks per cell. """
+        if not len(self.arrays):
+            return parsed
+        lowered = []
+        for line in parsed:
+            if not len(line) or line[0] not in ("@LOAD", "@STORE"):
+                lowered.append(line)
+                continue
+            if line[0] == "@LOAD":
+                temp, name, index, self.lineno = line[1:]
+                def leaf(k, source):
+                    return [temp, self.Expr([Token(TVAR, f"{name}#{k}", 0, 0)])]
+                source = None
+            else:
+                name, index, value, conditions, self.lineno = line[1:]
+                def leaf(k, source):
+                    element = f"{name}#{k}"
+                    tokens = tuple(source)
+                    for condition, inelse in conditions:
+                        if inelse:
+                            tokens = self.IfTokens(condition, (Token(TVAR, element, 0, 0),), tokens)
+                        else:
+                            tokens = self.IfTokens(condition, tokens, (Token(TVAR, element, 0, 0),))
+                    return [element, self.Expr(tokens)]
+                source = value.tokens
+            tree = self.ExprTree(index.tokens)
+            if self.IsConstant(tree):
+                lowered.append(leaf(self.ClampIndex(name, tree[0].number_), source))
+                continue
+            if line[0] == "@STORE":
+                lowered.append(["#AV", value])
+                source = (Token(TVAR, "#AV", 0, 0),)
+            if tree[0].type_ == TVAR:
+                param = tree[0].index_
+            else:
+                param = "#AI"
+                lowered.append([param, index])
+            self.anon_label_count += 1
+            prefix = f"A{self.anon_label_count}"
+            self.Dispatch(lowered, prefix, param, 0, self.arrays[name], lambda k: leaf(k, source))
+            self.Label(lowered, prefix + "End")
+        return lowered
+
+    def Dispatch(self, lowered: list, prefix: str, param: str, lo: int, hi: int, leaf):
+        """ Appends the states going from the current one to the state running leaf(k) for the value of param
+        in lo <= k < hi, then to the state prefix + "End" """
+        if hi - lo == 1:
+            lowered.append(leaf(lo))
+            lowered.append(["@GOTO", prefix + "End"])
+            return
+        mid = (lo + hi) // 2
+        left = f"{prefix}_{lo}_{mid}"
+        right = f"{prefix}_{mid}_{hi}"
+        # values below the first element go left and values past the last one go right, which clamps the index
+        lowered.append(["#AC", self.Expr([Token(TVAR, param, 0, 0), Token(TNUMBER, 0, 0, mid), Token(TOP2, '>=', 0, 0)])])
+        lowered.append(["@GOTO_UNLESS", left, "f#AC"])
+        lowered.append(["@GOTO", right])
+        self.Label(lowered, left)
+        self.Dispatch(lowered, prefix, param, lo, mid, leaf)
+        self.Label(lowered, right)
+        self.Dispatch(lowered, prefix, param, mid, hi, leaf)
+
+    def LowerLoops(self, parsed: list) -> list:
+        """ Replaces the ["@FOR", number, var, condition var, check, condition, body, step, increment var, increment,
+        first line, last line] lines of for loops by their labels and gotos. When optimizing, a loop whose variable takes
+        known integer values is unrolled instead: fully if that fits in the tasks of a state, so it takes no frames
+        of its own, or else a few iterations at a time. """
+        if not any(len(line) and line[0] == "@FOR" for line in parsed):
+            return parsed
+        lowered = []
+        known = {}
+        # lines still to lower, last first, so the loops in unrolled bodies get lowered in turn
+        pending = parsed[::-1]
+        while len(pending):
+            line = pending.pop()
+            if len(line) and line[0] == "@FOR":
+                pending.extend(self.LowerLoop(line, known)[::-1])
+                continue
+            lowered.append(line)
+            if self.optimize:
+                self.TrackConstants(line, known)
+        return lowered
+
+    def LowerLoop(self, loop: list, known: dict) -> list:
+        """ Returns the lines replacing the @FOR line loop, given the known constant values of variables before it """
+        number, var, condvar, check, condition, body, step, incvar, increment, begin, end = loop[1:]
+        if self.optimize and incvar == var and self.CanUnroll(var, body + step):
+            trips = self.TripValues(loop, known)
+            if trips is not None:
+                values, final = trips
+                budget = self.max_state_tasks or UNROLL_TASKS
+                costs = self.TripTasks(loop, values, known, budget)
+                if costs is not None and len(costs) == len(values) and sum(costs) <= budget:
+                    self.unrolled_loops += 1
+                    return self.Unrolled(loop, len(values))
+                # unrolled a few trips at a time, every group of them must fit
+                costs = self.TripTasks(loop, values, known, budget // 2, each=True)
+                if costs is not None and len(costs) == len(values):
+                    per_state = budget // max(costs, default=1)
+                    if per_state >= 2:
+                        self.unrolled_loops += 1
+                        # the first trips go per_state at a time, until the variable reaches the value it has after them
+                        whole = len(values) // per_state * per_state
+                        stop = values[whole] if whole < len(values) else final
+                        check = []
+                        condition = self.Expr([Token(TVAR, var, 0, 0), Token(TNUMBER, 0, 0, stop), Token(TOP2, '!=', 0, 0)])
+                        body = self.Unrolled(loop, per_state)
+                        step = []
+                        increment = None
+                        lowered = self.LoopLines(number, condvar, check, condition, body, step, incvar, increment, begin, end)
+                        return lowered + self.Unrolled(loop, len(values) - whole)
+        return self.LoopLines(number, condvar, check, condition, body, step, incvar, increment, begin, end)
+
+    def LoopLines(self, number, condvar: str, check: list, condition, body: list, step: list, incvar: str, increment, begin: int, end: int) -> list:
+        """ Returns the labels and gotos of a for loop around body, checking condition before every iteration """
+        if number is None:
+            # a copy of a loop in an unrolled body needs labels of its own
+            self.anon_label_count += 1
+            number = self.anon_label_count
+        name = f"F{number}"
+        lines = []
+        self.lineno = begin
+        self.Label(lines, name)
+        lines.extend(check)
+        lines.append([condvar, condition])
+        lines.append(["@GOTO_UNLESS", name + "End", "f"+condvar])
+        lines.append(["@GOTO", name + "Loop"])
+        self.Label(lines, name + "Loop")
+        lines.extend(body)
+        lines.extend(step)
+        if increment is not None:
+            lines.append([incvar, increment])
+        lines.append(["@GOTO", name])
+        self.lineno = end
+        self.Label(lines, name + "End")
+        return lines
+
+    def Unrolled(self, loop: list, trips: int) -> list:
+        """ Returns trips copies of the body, step and increment of the @FOR line loop """
+        body, step, incvar, increment = loop[6:10]
+        lines = []
+        for n in range(trips):
+            lines.extend(self.CloneLines(body))
+            lines.extend(self.CloneLines(step))
+            lines.append([incvar, self.Expr(increment.tokens)])
+        return lines
+
+    def CloneLines(self, lines: list) -> list:
+        """ Copies lines so that passes changing the tokens of one copy leave the others alone """
+        copies = []
+        for line in lines:
+            if len(line) and line[0] == "@FOR":
+                copies.append(["@FOR", None, *line[2:4], self.CloneLines(line[4]), self.Expr(line[5].tokens), self.CloneLines(line[6]),
+                               self.CloneLines(line[7]), line[8], self.Expr(line[9].tokens), *line[10:]])
+                continue
+            copies.append([self.Expr(v.tokens) if type(v) is Expression else list(v) if type(v) is list else v for v in line])
+        return copies
+
+    def CanUnroll(self, var: str, lines: list) -> bool:
+        """ Whether lines can be repeated in place of a loop over var: they may not change var,
+        nor contain labels, gotos or outputs, which are not straight-line code or would be declared twice """
+        for line in lines:
+            if not len(line):
+                continue
+            if line[0] == "@FOR":
+                if line[2] == var or line[8] == var or not self.CanUnroll(var, line[4] + line[6] + line[7]):
+                    return False
+            elif line[0] in ("@LABEL", "@GOTO", "@GOTO_UNLESS", "@OUTPUT"):
+                return False
+            elif line[0] == var:
+                return False
+        return True
+
+    def Written(self, lines: list) -> tuple:
+        """ Returns the variables lines may assign, and the arrays they may store to with a variable index """
+        variables = set()
+        arrays = set()
+        for line in lines:
+            if not len(line):
+                continue
+            if line[0] == "@FOR":
+                variables.update((line[2], line[3], line[8]))
+                inner = self.Written(line[4] + line[6] + line[7])
+                variables.update(inner[0])
+                arrays.update(inner[1])
+            elif line[0] == "@LOAD":
+                variables.add(line[1])
+            elif line[0] == "@STORE":
+                arrays.add(line[1])
+            elif not line[0].startswith("@"):
+                variables.add(line[0])
+        return variables, arrays
+
+    def Unknown(self, known: dict, lines: list) -> dict:
+        """ Returns the values of known that hold all along a loop over lines """
+        variables, arrays = self.Written(lines)
+        return {var: v for var, v in known.items() if var not in variables and var.split("#")[0] not in arrays}
+
+    def TripValues(self, loop: list, known: dict):
+        """ Returns the values the variable of the @FOR line loop takes on each iteration and its value after the loop,
+        or None if they are not all known integers the animator holds exactly, or there are more than UNROLL_TRIPS.
+        They are worked out on 32 bit floats like the animator does, so the loop unrolls as many times as it would run. """
+        var, check, condition, body, step, incvar, increment = loop[2], loop[4], loop[5], loop[6], loop[7], loop[8], loop[9]
+        if var not in known or len(check) or len(step) or incvar != var:
+            return None
+        condition = self.ExprTree(condition.tokens)
+        increment = self.ExprTree(increment.tokens)
+        if condition is None or increment is None:
+            return None
+        inside = self.Unknown(known, body)
+        # a constant the variable was set to may be one the animator reads rounded
+        value = _float32(known[var]) if type(known[var]) in (int, float) else known[var]
+        values = []
+        while True:
+            if type(value) not in (int, float) or not float(value).is_integer() or abs(value) > 2**24:
+                return None
+            inside[var] = value
+            result = self.FoldTree(condition, inside)
+            if not self.IsConstant(result):
+                return None
+            # the loop leaves through a goto_unless, taken when the condition is below 1
+            if result[0].number_ < 1:
+                return values, value
+            if len(values) >= UNROLL_TRIPS:
+                return None
+            values.append(value)
+            result = self.FoldTree(increment, inside)
+            if not self.IsConstant(result):
+                return None
+            value = result[0].number_
+
+    def TripTasks(self, loop: list, values: list, known: dict, limit: int, each: bool = False):
+        """ Returns about how many driver tasks each iteration of the @FOR line loop takes once unrolled, the variable
+        taking values, or None if a loop in it does not run a known number of times. Stops after the iteration where
+        the total, or with each the tasks of that iteration alone, go over limit. """
+        body = loop[6] + loop[7]
+        inside = self.Unknown(known, body)
+        costs = []
+        total = 0
+        for value in values:
+            inside[loop[2]] = value
+            tasks = self.EstimateTasks(body, inside, limit)
+            if tasks is None:
+                return None
+            costs.append(tasks + 1)
+            total += tasks + 1
+            if (tasks + 1 if each else total) > limit:
+                break
+        return costs
+
+    def EstimateTasks(self, lines: list, known: dict, limit: int):
+        """ Returns about how many driver tasks lines take once their loops are unrolled, one per operator,
+        or None if a loop in them does not run a known number of times. Stops counting once past limit. """
+        known = dict(known)
+        tasks = 0
+        for line in lines:
+            if tasks > limit:
+                break
+            if not len(line):
+                continue
+            if line[0] == "@FOR":
+                trips = self.TripValues(line, known)
+                if trips is None:
+                    return None
+                values, final = trips
+                # the iterations of an inner loop may depend on the outer variable, so every one of them counts
+                costs = self.TripTasks(line, values, known, limit - tasks)
+                if costs is None:
+                    return None
+                tasks += sum(costs)
+                known = self.Unknown(known, [line])
+                known[line[2]] = final
+                continue
+            if line[0].startswith("@") and line[0] not in ("@LOAD", "@STORE"):
+                continue
+            expressions = [v for v in line if type(v) is Expression]
+            tasks += max(1, sum(1 for e in expressions for t in e.tokens
+                                if t.type_ in (TOP1, TFUNCALL) or t.type_ == TOP2 and t.index_ not in (',', '||')))
+            self.TrackConstants(line, known)
+        return tasks
+
+    def TrackConstants(self, line: list, known: dict):
+        """ Updates known, the constant values of variables, past line the way PropagateConstants does """
+        if not len(line):
+            return
+        if line[0] == "@LABEL":
+            known.clear()
+        elif line[0] == "@LOAD":
+            known.pop(line[1], None)
+        elif line[0] == "@STORE":
+            for var in [v for v in known if v.startswith(line[1] + "#")]:
+                del known[var]
+        elif not line[0].startswith("@"):
+            tree = self.ExprTree(line[1].tokens)
+            if tree is not None:
+                tree = self.FoldTree(tree, known)
+            if tree is not None and self.IsConstant(tree):
+                known[line[0]] = tree[0].number_
+            else:
+                known.pop(line[0], None)
+
+    def FormatInstruction(self, instr: list) -> str:
+        return f"{instr[0]} {', '.join(instr[1:])}"
+
+    def Emit(self, instructions: list, values, op: str, dest: str, *args) -> str:
+        """ Appends the instruction op fdest, args... and returns the name of the parameter holding its result.
+        If the ValueTable values has a parameter still holding the same result, that is returned instead. """
+        key = (op, *(sorted(args) if op in COMMUTATIVE_OPS else args))
+        if values is not None and key in values.results:
+            return values.results[key]
+        if op in BUILTINS:
+            self.ExpandBuiltin(instructions, op, dest, *args)
+        else:
+            instructions.append([op, "f"+dest, *args])
+        if values is not None:
+            values.Clobber("f"+dest)
+            if op not in IMPURE_OPS and "f"+dest not in args:
+                values.Put(key, dest)
+        return dest
+
+    def ExpandBuiltin(self, instructions: list, op: str, dest: str, *args):
+        """ Appends the driver tasks of the builtin op writing fdest, with its own virtual temporaries """
+        names = {"$A": "f"+dest}
+        for name, arg in zip(("$B", "$C"), args):
+            names[name] = arg
+        for instr in BUILTINS[op]:
+            for arg in instr[1:]:
+                if arg.startswith("$T") and arg not in names:
+                    names[arg] = f"f#V{self.virtual_temps}"
+                    self.virtual_temps += 1
+            instructions.append([names.get(arg, arg) for arg in instr])
+
+    def _CompileExpr(self, line, values=None):
+        """ Generates the instructions computing one [var, Expression] line.
+        values is shared by the lines of a state for common subexpression elimination, or None to disable it. """
         instructions = []
         i = 0
         acc = []
@@ -376,33 +1020,25 @@ class Compiler:
             if lastToken:
                 destparam = line[0]
             else:
-                destparam = "#BuiltinTmpA"
+                # every intermediate result gets its own temporary, AllocateTemps packs them into #T parameters
+                destparam = f"#V{self.virtual_temps}"
+                self.virtual_temps += 1
             if type(token) is Token:
-                if token.type_ == TNUMBER:
-                    if lastToken:
-                        instructions.append(f"set f{line[0]}, {token.number_}")
-                    else:
-                        acc.append(token)
-                elif token.type_ == TVAR:
-                    if lastToken:
-                        instructions.append(f"set f{line[0]}, f{token.index_}")
-                    else:
-                        acc.append(token)
+                if token.type_ == TNUMBER or token.type_ == TVAR:
+                    acc.append(token)
                 elif token.type_ == TOP1:
-                    if token.index_ == '-':
-                        instructions.append(f"negate f{destparam}, f{line[0]}")
-                        acc.append(Token(TVAR, destparam, 0, 0))
-                    elif len(acc) >= 1:
+                    if len(acc) >= 1:
                         arg = acc.pop()
-                        if arg.type_ == TNUMBER:
-                            val = self.parser.ops1[token.index_](arg.number_)
+                        val = self.Fold(self.parser.ops1[token.index_], arg.number_) if arg.type_ == TNUMBER else None
+                        if val is not None:
                             acc.append(Token(TNUMBER, 0, 0, val))
-                        elif arg.type_ == TVAR:
-                            op = self.SymbolToOperator(token.index_)
+                        elif arg.type_ in (TNUMBER, TVAR):
+                            # unary minus shares its symbol with subtraction
+                            op = "negate" if token.index_ == '-' else self.SymbolToOperator(token.index_)
                             if not len(op):
                                 self.InternalError(f"Unknown operator \"{token.index_}\"")
-                            instructions.append(f"{op} f{destparam}, {self.TokenToArg(arg)}")
-                            acc.append(Token(TVAR, destparam, 0, 0))
+                            result = self.Emit(instructions, values, op, destparam, self.TokenToArg(arg))
+                            acc.append(Token(TVAR, result, 0, 0))
                         else:
                             self.InternalError()
                     else:
@@ -427,15 +1063,17 @@ class Compiler:
                             acc.append(arg1)
                             continue
 
+                        val = None
                         if arg2.type_ == TNUMBER and arg1.type_ == TNUMBER:
-                            val = self.parser.ops2[token.index_](arg1.number_, arg2.number_)
+                            val = self.Fold(self.parser.ops2[token.index_], arg1.number_, arg2.number_)
+                        if val is not None:
                             acc.append(Token(TNUMBER, 0, 0, val))
-                        elif arg1.type_ == TVAR or arg2.type_ == TVAR:
+                        elif arg1.type_ in (TNUMBER, TVAR) and arg2.type_ in (TNUMBER, TVAR):
                             op = self.SymbolToOperator(token.index_)
                             if not len(op):
                                 self.InternalError(f"Unknown operator \"{token.index_}\"")
-                            instructions.append(f"{op} f{destparam}, {self.TokenToArg(arg1)}, {self.TokenToArg(arg2)}")
-                            acc.append(Token(TVAR, destparam, 0, 0))
+                            result = self.Emit(instructions, values, op, destparam, self.TokenToArg(arg1), self.TokenToArg(arg2))
+                            acc.append(Token(TVAR, result, 0, 0))
                         else:
                             self.InternalError()
                     else:
@@ -456,27 +1094,16 @@ class Compiler:
                             self.InternalError(f"Unknown function \"{op.index_}\"")
                         op = self.SymbolToOperator(op.index_)
                         if len(op):
-                            if type(arg) is list:
-                                if all([a.type_ == TNUMBER for a in arg]):
-                                    arg = [a.number_ for a in arg]
-                                    acc.append(Token(TNUMBER, 0, 0, opf(*arg)))
-                                else:
-                                    instructions.append(f"{op} f{destparam}," + ", ".join([self.TokenToArg(a) for a in arg]))
-                                    acc.append(Token(TVAR, destparam, 0, 0))
-                            elif arg.type_ == TNUMBER and type(arg.number_) is list:
-                                arg = arg.number_
-                                if all([a.type_ == TNUMBER for a in arg]):
-                                    arg = [a.number_ for a in arg]
-                                    acc.append(Token(TNUMBER, 0, 0, opf(*arg)))
-                                else:
-                                    instructions.append(f"{op} f{destparam}," + ", ".join([self.TokenToArg(a) for a in arg]))
-                                    acc.append(Token(TVAR, destparam, 0, 0))
+                            if type(arg) is not list:
+                                arg = arg.number_ if arg.type_ == TNUMBER and type(arg.number_) is list else [arg]
+                            val = None
+                            if all([a.type_ == TNUMBER for a in arg]):
+                                val = self.Fold(opf, *[a.number_ for a in arg])
+                            if val is not None:
+                                acc.append(Token(TNUMBER, 0, 0, val))
                             else:
-                                if arg.type_ == TNUMBER:
-                                    acc.append(Token(TNUMBER, 0, 0, opf(arg)))
-                                else:
-                                    instructions.append(f"{op} f{destparam}, {self.TokenToArg(arg)}")
-                                    acc.append(Token(TVAR, destparam, 0, 0))
+                                result = self.Emit(instructions, values, op, destparam, *[self.TokenToArg(a) for a in arg])
+                                acc.append(Token(TVAR, result, 0, 0))
                         else:
                             self.InternalError(f"Unknown function: \"{token.index_}\"")
                     else:
@@ -487,39 +1114,689 @@ class Compiler:
                 if len(acc) > 0:
                     arg = self.TokenToArg(acc.pop())
                     if f"f{destparam}" != arg:
-                        instructions.append(f"set f{destparam}, {arg}")
+                        instructions.append(["set", f"f{destparam}", arg])
+                        if values is not None:
+                            values.Clobber(f"f{destparam}")
         return instructions
 
+    def Preprocess(self, source: str):
+        """ Yields (statement, line, column) for every ";" separated statement of source in a single pass.
+        Line comments, block comments and the implied ";" after an "end" at the end of a line are handled here.
+        line and column are 1-based and point at the first non-whitespace character of the statement. """
+        block = False
+        chunks = []
+        tail = ""
+        begin = (1, 1)
+        start = None
+        lines = source.split("\n")
+        for lineno, text in enumerate(lines, 1):
+            # remove line comments
+            if text.startswith("//"):
+                text = ""
+            # remove block comments
+            pos = 0
+            while pos < len(text):
+                if block:
+                    close = text.find("*/", pos)
+                    if close < 0:
+                        break
+                    block = False
+                    pos = close + 2
+                    continue
+                opening = text.find("/*", pos)
+                if opening < 0:
+                    opening = len(text)
+                else:
+                    block = True
+                    self.lineno, self.column = lineno, opening + 1
+                # split code lines
+                while pos < opening:
+                    semi = text.find(";", pos, opening)
+                    piece = text[pos:opening] if semi < 0 else text[pos:semi]
+                    if start is None:
+                        stripped = piece.lstrip(" \n\t")
+                        if len(stripped):
+                            start = (lineno, pos + len(piece) - len(stripped) + 1)
+                    chunks.append(piece)
+                    if semi < 0:
+                        tail = (tail + piece)[-3:]
+                        pos = opening
+                        break
+                    yield "".join(chunks), *(start or begin)
+                    chunks = []
+                    tail = (piece + ";")[-3:]
+                    begin = (lineno, semi + 2)
+                    start = None
+                    pos = semi + 1
+                pos = opening + 2
+            if lineno == len(lines) or block:
+                continue
+            # add implied semicolons to ends
+            if tail == "end":
+                yield "".join(chunks), *(start or begin)
+                chunks = []
+                begin = (lineno + 1, 1)
+                start = None
+                tail = ";"
+            chunks.append("\n")
+            tail = (tail + "\n")[-3:]
+        if block:
+            self.Error("Missing end comment \"*/\"")
+        yield "".join(chunks), *(start or begin)
+
+    def ExprTree(self, tokens):
+        """ Builds a (token, children) tree from postfix tokens, or returns None if they do not form exactly one expression.
+        TFUNCALL nodes have the function as their first child and the argument (or "," list) as the second. """
+        stack = []
+        for t in tokens:
+            if t.type_ in (TNUMBER, TVAR):
+                n = 0
+            elif t.type_ == TOP1:
+                n = 1
+            elif t.type_ in (TOP2, TFUNCALL):
+                n = 2
+            else:
+                return None
+            if len(stack) < n:
+                return None
+            children = stack[len(stack)-n:]
+            del stack[len(stack)-n:]
+            stack.append((t, children))
+        if len(stack) != 1:
+            return None
+        return stack[0]
+
+    def FlattenTree(self, node, out=None) -> list:
+        if out is None:
+            out = []
+        for child in node[1]:
+            self.FlattenTree(child, out)
+        out.append(node[0])
+        return out
+
+    def IsConstant(self, node) -> bool:
+        return node[0].type_ == TNUMBER and type(node[0].number_) in (int, float)
+
+    def Constant(self, value):
+        # comparisons fold to bools, which the assembler would read as parameter names
+        if type(value) is bool:
+            value = int(value)
+        return (Token(TNUMBER, 0, 0, value), [])
+
+    def FoldTree(self, node, known: dict):
+        """ Returns node with the variables in known replaced by their values and constant operations evaluated """
+        token, children = node
+        if token.type_ == TVAR:
+            if token.index_ in known:
+                return self.Constant(known[token.index_])
+            return node
+        if token.type_ == TNUMBER:
+            return node
+        if token.type_ == TFUNCALL:
+            # never substitute the function itself
+            children = [children[0], self.FoldTree(children[1], known)]
+        else:
+            children = [self.FoldTree(c, known) for c in children]
+        value = None
+        # "not" folds as a logical not but runs as a bitwise one, so leave it alone
+        if token.type_ == TOP1 and self.IsConstant(children[0]) and token.index_ in self.parser.ops1 and token.index_ != "not":
+            value = self.Fold(self.parser.ops1[token.index_], children[0][0].number_)
+        elif token.type_ == TOP2 and token.index_ not in (',', '||', 'D') and all(self.IsConstant(c) for c in children):
+            value = self.Fold(self.parser.ops2[token.index_], children[0][0].number_, children[1][0].number_)
+        elif token.type_ == TFUNCALL and children[0][0].type_ == TVAR:
+            name = children[0][0].index_
+            args = [children[1]]
+            while args[0][0].type_ == TOP2 and args[0][0].index_ == ',':
+                args[0:1] = args[0][1]
+            if name == "if" and len(args) == 3 and self.IsConstant(args[0]):
+                return args[1] if self.parser.functions["if"](args[0][0].number_, True, False) else args[2]
+            if name not in ("random",) and all(self.IsConstant(a) for a in args):
+                for table in (self.parser.functions, self.parser.ops1, self.parser.ops2, self.parser.values):
+                    if name in table:
+                        value = self.Fold(table[name], *[a[0].number_ for a in args])
+                        break
+        if value is not None:
+            return self.Constant(value)
+        return (token, children)
+
+    def Fold(self, f, *args):
+        """ Returns f(*args) on the 32 bit floats the animator computes with, so it is the value the animator would get,
+        or None if that fails or is not a finite number, to leave the operation for the animator """
+        try:
+            value = f(*[_float32(a) if type(a) in (int, float) else a for a in args])
+            if type(value) is bool:
+                value = int(value)
+            if type(value) in (int, float) and math.isfinite(value):
+                return _float32(value)
+        except (ArithmeticError, ValueError, TypeError):
+            pass
+        return None
+
+    def Operation(self, node):
+        """ Returns the operator and argument nodes of an operator or function call node, or (None, []) """
+        token, children = node
+        if token.type_ == TOP2:
+            return self.SymbolToOperator(token.index_), children
+        if token.type_ == TFUNCALL and children[0][0].type_ == TVAR:
+            args = [children[1]]
+            while args[0][0].type_ == TOP2 and args[0][0].index_ == ',':
+                args[0:1] = args[0][1]
+            return self.SymbolToOperator(children[0][0].index_), args
+        return None, []
+
+    def IsIntegral(self, node) -> bool:
+        if self.IsConstant(node):
+            return float(node[0].number_).is_integer()
+        op, args = self.Operation(node)
+        if op in INTEGER_OPS:
+            return True
+        return op in ("add", "sub", "mul") and all(self.IsIntegral(a) for a in args)
+
+    def IsPure(self, node) -> bool:
+        op, args = self.Operation(node)
+        if op in IMPURE_OPS:
+            return False
+        return all(self.IsPure(c) for c in node[1])
+
+    def Reduced(self, name: str, node):
+        """ Returns node as the result of the rewrite name, counting it """
+        before, after = STRENGTH_REDUCTIONS[name]
+        if after > before:
+            self.InternalError(f"Strength reduction \"{name}\" adds tasks")
+        self.reductions[name] = self.reductions.get(name, 0) + 1
+        self.reduced_tasks += before - after
+        return node
+
+    def ReduceAssigned(self, node, target: str):
+        """ Returns ReduceTree(node) for the expression assigned to target. An operation rewritten down to an operand
+        no longer writes target itself, so unless that operand is target the set copying it takes back one task saved. """
+        reduced = self.ReduceTree(node)
+        if len(node[1]) and not len(reduced[1]) and not (reduced[0].type_ == TVAR and reduced[0].index_ == target):
+            self.reduced_tasks -= 1
+        return reduced
+
+    def ReduceTree(self, node):
+        """ Returns node with operations on constants rewritten into fewer or cheaper driver tasks, see STRENGTH_REDUCTIONS """
+        token, children = node
+        if token.type_ == TFUNCALL:
+            children = [children[0], self.ReduceTree(children[1])]
+        else:
+            children = [self.ReduceTree(c) for c in children]
+        node = (token, children)
+        op, args = self.Operation(node)
+        if len(args) != 2:
+            return node
+        a, b = args
+        k = b[0].number_ if self.IsConstant(b) else None
+        if op == "pow" and k is not None:
+            if k == 0:
+                return self.Reduced("pow_zero", self.Constant(1))
+            if k == 1:
+                return self.Reduced("pow_one", a)
+            # x is computed once either way, common subexpression elimination reuses it
+            if k == 2 and self.IsPure(a):
+                return self.Reduced("pow_two", (Token(TOP2, '*', 0, 0), [a, a]))
+        elif op == "mul":
+            if k == 1:
+                return self.Reduced("mul_one", a)
+            if self.IsConstant(a) and a[0].number_ == 1:
+                return self.Reduced("mul_one", b)
+        elif op == "div" and k is not None:
+            if k == 1:
+                return self.Reduced("div_one", a)
+            m, e = math.frexp(k)
+            if abs(m) == 0.5 and -126 <= e - 1 <= 126:
+                return self.Reduced("div_power_of_two", (Token(TOP2, '*', 0, 0), [a, self.Constant(1 / k)]))
+        elif op == "add":
+            if k == 0:
+                return self.Reduced("add_zero", a)
+            if self.IsConstant(a) and a[0].number_ == 0:
+                return self.Reduced("add_zero", b)
+        elif op == "sub" and k == 0:
+            return self.Reduced("sub_zero", a)
+        elif op in ("shl", "shr") and k is not None and float(k).is_integer() and self.IsIntegral(a):
+            # both shifts truncate x first, which only leaves integers alone
+            if k == 0:
+                return self.Reduced("shift_zero", a)
+            if op == "shl" and 0 < k < 32:
+                return self.Reduced("shl_constant", (Token(TOP2, '*', 0, 0), [a, self.Constant(2 ** int(k))]))
+        return node
+
+    def PropagateConstants(self, parsed: list):
+        """ Replaces variables with their known constant values, folds the results and reduces their strength, within straight-line code.
+        Nothing is known at a label since it can be reached from elsewhere. """
+        known = {}
+        for line in parsed:
+            if not len(line):
+                continue
+            if line[0] == "@LABEL":
+                known.clear()
+                continue
+            if line[0] == "@LOAD":
+                line[3].tokens = tuple(self.FlattenTree(self.ReduceTree(self.FoldTree(self.ExprTree(line[3].tokens), known))))
+                known.pop(line[1], None)
+                continue
+            if line[0] == "@STORE":
+                index = self.ExprTree(line[2].tokens)
+                if index is not None:
+                    index = self.ReduceTree(self.FoldTree(index, known))
+                    line[2].tokens = tuple(self.FlattenTree(index))
+                value = self.ExprTree(line[3].tokens)
+                if value is not None:
+                    value = self.FoldTree(value, known)
+                    # LowerArrays copies the value to #AV, or to the element when the index is constant,
+                    # unless the store is conditional and the value goes straight into the cond choosing the element
+                    if index is not None and self.IsConstant(index) and len(line[4]):
+                        value = self.ReduceTree(value)
+                    else:
+                        value = self.ReduceAssigned(value, "#AV")
+                    line[3].tokens = tuple(self.FlattenTree(value))
+                # any element may have been written
+                for var in [v for v in known if v.startswith(line[1] + "#")]:
+                    del known[var]
+                continue
+            if line[0].startswith("@"):
+                continue
+            tree = self.ExprTree(line[1].tokens)
+            if tree is None:
+                known.pop(line[0], None)
+                continue
+            tree = self.ReduceAssigned(self.FoldTree(tree, known), line[0])
+            line[1].tokens = tuple(self.FlattenTree(tree))
+            if self.IsConstant(tree):
+                known[line[0]] = tree[0].number_
+            else:
+                known.pop(line[0], None)
+
+    def AllocateTemps(self, instructions: list) -> int:
+        """ Renames the virtual temporaries (f#V) in the instructions of a state to as few f#T parameters as possible.
+        A temporary is live from the instruction writing it to the last one reading it, nothing is live across states.
+        Returns the number of f#T parameters used. """
+        last = {}
+        for i, instr in enumerate(instructions):
+            for arg in instr[2:]:
+                if arg.startswith("f#V"):
+                    last[arg] = i
+        assigned = {}
+        free = []
+        count = 0
+        for i, instr in enumerate(instructions):
+            # an instruction may read the same temporary twice, it only frees it once
+            dying = list(dict.fromkeys(assigned[arg] for arg in instr[2:] if last.get(arg) == i))
+            instr[2:] = [assigned.get(arg, arg) for arg in instr[2:]]
+            # a single task reads its arguments before writing, anything else may not
+            if instr[0] in DRIVER_OPS:
+                free.extend(dying)
+                dying = []
+            if instr[1].startswith("f#V"):
+                if len(free):
+                    free.sort()
+                    reg = free.pop(0)
+                else:
+                    reg = f"f#T{count}"
+                    count += 1
+                assigned[instr[1]] = reg
+                if instr[1] not in last:
+                    dying.append(reg)
+                instr[1] = reg
+            free.extend(dying)
+        return count
+
+    def EliminateDeadStores(self, layer: dict):
+        """ Removes instructions whose result is overwritten or never read on any path through the layer's states,
+        then forgets the variables no remaining instruction, goto or output refers to.
+        Outputs are read every frame, so their variables are live everywhere. """
+        states = layer["states"]
+        pinned = set("f"+o["var"] for o in self.outputters)
+        changed = True
+        predecessors = {name: set() for name in states}
+        for name, state in states.items():
+            for succ in self.Successors(name, state):
+                predecessors.setdefault(succ, set()).add(name)
+        while changed:
+            # variables read before being written in each state, and variables written by it
+            gen = {}
+            kill = {}
+            for name, state in states.items():
+                gen[name] = set()
+                kill[name] = set()
+                for instr in reversed(state["instructions"]):
+                    gen[name].discard(instr[1])
+                    kill[name].add(instr[1])
+                    gen[name].update(arg for arg in instr[2:] if arg.startswith("f"))
+            # liveness of the states as they are now, iterated to a fixed point
+            live_in = {name: set() for name in states}
+            work = list(states.keys())
+            pending = set(work)
+            while len(work):
+                name = work.pop()
+                pending.discard(name)
+                live = (self.LiveOut(name, states[name], live_in, pinned) - kill[name]) | gen[name]
+                if live != live_in[name]:
+                    live_in[name] = live
+                    for pred in predecessors.get(name, ()):
+                        if pred not in pending:
+                            pending.add(pred)
+                            work.append(pred)
+            changed = False
+            for name, state in states.items():
+                live = self.LiveOut(name, state, live_in, pinned)
+                kept = []
+                for instr in reversed(state["instructions"]):
+                    if instr[1] not in live:
+                        changed = True
+                        continue
+                    live.discard(instr[1])
+                    live.update(arg for arg in instr[2:] if arg.startswith("f"))
+                    kept.append(instr)
+                kept.reverse()
+                state["instructions"] = kept
+        used = set(pinned)
+        for state in states.values():
+            for instr in state["instructions"]:
+                used.update(instr[1:])
+            used.update(g["condition"] for g in state["gotos"] if "condition" in g)
+        for var in [v for v in self.vars if "f"+v not in used]:
+            del self.vars[var]
+
+    def Successors(self, name: str, state: dict) -> list:
+        successors = [g["state"] for g in state["gotos"]]
+        # a state whose gotos are all conditional may run again
+        if len(state["gotos"]) and all("condition" in g for g in state["gotos"]):
+            successors.append(name)
+        return successors
+
+    def LiveOut(self, name: str, state: dict, live_in: dict, pinned: set) -> set:
+        live = set(pinned)
+        for succ in self.Successors(name, state):
+            live |= live_in.get(succ, set())
+        for goto in state["gotos"]:
+            if "condition" in goto:
+                live.add(goto["condition"])
+        return live
+
+    def MergeStates(self, layer: dict) -> int:
+        """ Shortens the goto chains between the layer's states, since entering a state costs an animator frame.
+        Gotos to a state with no instructions and a single unconditional goto go to its target instead,
+        a state entered only by the lone unconditional goto of another state is appended to that state,
+        and states nothing goes to are dropped. A state never goes to itself, that needs its "#loop" state.
+        Returns the number of states removed. """
+        states = layer["states"]
+        removed = 0
+        changed = True
+        while changed:
+            changed = False
+            predecessors = {name: [] for name in states}
+            for name, state in states.items():
+                for goto in state["gotos"]:
+                    if name not in predecessors[goto["state"]]:
+                        predecessors[goto["state"]].append(name)
+            for name in list(states.keys()):
+                if name == "entry" or name not in states:
+                    continue
+                state = states[name]
+                preds = predecessors[name]
+                if not len(state["instructions"]) and len(state["gotos"]) == 1 and "condition" not in state["gotos"][0]:
+                    target = state["gotos"][0]["state"]
+                    for pred in list(preds):
+                        if pred == target or pred == name:
+                            continue
+                        for goto in states[pred]["gotos"]:
+                            if goto["state"] == name:
+                                goto["state"] = target
+                        preds.remove(pred)
+                        if pred not in predecessors[target]:
+                            predecessors[target].append(pred)
+                        changed = True
+                elif len(preds) == 1 and preds[0] != name:
+                    pred = states[preds[0]]
+                    successors = [g["state"] for g in state["gotos"]]
+                    if len(pred["gotos"]) == 1 and "condition" not in pred["gotos"][0] and preds[0] not in successors:
+                        pred["instructions"] = pred["instructions"] + state["instructions"]
+                        pred["gotos"] = state["gotos"]
+                        for succ in successors:
+                            if name in predecessors[succ]:
+                                predecessors[succ].remove(name)
+                            if preds[0] not in predecessors[succ]:
+                                predecessors[succ].append(preds[0])
+                        preds.clear()
+                        changed = True
+                if not len(preds):
+                    for goto in states[name]["gotos"]:
+                        if name in predecessors[goto["state"]]:
+                            predecessors[goto["state"]].remove(name)
+                    del states[name]
+                    removed += 1
+                    changed = True
+        self.removed_states += removed
+        return removed
+
+    def SplitStates(self, layer: dict, max_tasks: int) -> int:
+        """ Splits every state of the layer running more than max_tasks tasks into a chain of states,
+        each going to the next on the following frame, the last one keeping the gotos.
+        Returns the number of states added. """
+        states = {}
+        added = 0
+        for name, state in layer["states"].items():
+            instructions = state["instructions"]
+            part = name
+            while len(instructions) > max_tasks:
+                added += 1
+                following = f"{name}#part{added}"
+                states[part] = {"instructions": instructions[:max_tasks], "gotos": [{"state": following}]}
+                instructions = instructions[max_tasks:]
+                part = following
+            states[part] = {"instructions": instructions, "gotos": state["gotos"]}
+        layer["states"] = states
+        self.split_states += added
+        return added
+
+    def StronglyConnected(self, nodes: list, edges: dict) -> list:
+        """ Returns the strongly connected components of the graph, found iteratively so large layers do not hit the recursion limit """
+        index = {}
+        low = {}
+        stack = []
+        on_stack = set()
+        components = []
+        for root in nodes:
+            if root in index:
+                continue
+            work = [(root, 0)]
+            while len(work):
+                node, i = work.pop()
+                if i == 0:
+                    index[node] = low[node] = len(index)
+                    stack.append(node)
+                    on_stack.add(node)
+                succs = edges[node]
+                descended = False
+                while i < len(succs):
+                    succ = succs[i]
+                    i += 1
+                    if succ not in index:
+                        work.append((node, i))
+                        work.append((succ, 0))
+                        descended = True
+                        break
+                    if succ in on_stack:
+                        low[node] = min(low[node], index[succ])
+                if descended:
+                    continue
+                if low[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    components.append(component)
+                if len(work):
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[node])
+        return components
+
+    def FindLoops(self, nodes: list, edges: dict, predecessors: dict, order: dict, depth: int = 0) -> list:
+        """ Returns the loops among nodes, outermost first, as (header, members, depth).
+        The header of a loop is its first state entered from outside, inner loops are found without it. """
+        loops = []
+        inside = set(nodes)
+        sub = {n: [s for s in edges[n] if s in inside] for n in nodes}
+        for component in self.StronglyConnected(nodes, sub):
+            if len(component) == 1 and component[0] not in sub[component[0]]:
+                continue
+            members = sorted(component, key=order.get)
+            member_set = set(members)
+            entered = [m for m in members if any(p not in member_set for p in predecessors[m])]
+            header = entered[0] if len(entered) else members[0]
+            loops.append((header, members, depth))
+            loops.extend(self.FindLoops([m for m in members if m != header], edges, predecessors, order, depth + 1))
+        return loops
+
+    def Stats(self) -> dict:
+        """ Static cost report of the compiled layers: driver tasks, parameters and fan-out of every state,
+        and the frames and tasks of one iteration of every loop along its shortest path """
+        report = {
+            "version": CompilerVersion(),
+            "parameters": len([v for v in self.vars if not self.vars[v]["constant"]]) + self.temps,
+            "states": 0,
+            "tasks": 0,
+            "removed_states": self.removed_states,
+            "unrolled_loops": self.unrolled_loops,
+            "split_states": self.split_states,
+            "reductions": dict(self.reductions),
+            "reduced_tasks": self.reduced_tasks,
+            "layers": [],
+        }
+        for layer in self.layers:
+            states = layer["states"]
+            order = {name: i for i, name in enumerate(states)}
+            edges = {name: list(dict.fromkeys(g["state"] for g in state["gotos"])) for name, state in states.items()}
+            predecessors = {name: [] for name in states}
+            for name in states:
+                for succ in edges[name]:
+                    predecessors[succ].append(name)
+            tasks = {}
+            state_stats = []
+            for name, state in states.items():
+                tasks[name] = len(state["instructions"])
+                params = set()
+                for instr in state["instructions"]:
+                    params.update(arg for arg in instr[1:] if arg.startswith("f"))
+                params.update(g["condition"] for g in state["gotos"] if "condition" in g)
+                state_stats.append({
+                    "name": name,
+                    "line": self.label_lines.get(name.split("#")[0]),
+                    "instructions": len(state["instructions"]),
+                    "tasks": tasks[name],
+                    "parameters": len(params),
+                    "fan_out": len(edges[name]),
+                })
+            loop_stats = []
+            for header, members, depth in self.FindLoops(list(states.keys()), edges, predecessors, order):
+                member_set = set(members)
+                # shortest way around the loop, back to its header
+                previous = {}
+                frontier = [header]
+                while len(frontier) and header not in previous:
+                    following = []
+                    for n in frontier:
+                        for succ in edges[n]:
+                            if succ in member_set and succ not in previous:
+                                previous[succ] = n
+                                following.append(succ)
+                    frontier = following
+                path = [header]
+                while previous[path[-1]] != header:
+                    path.append(previous[path[-1]])
+                loop_stats.append({
+                    "header": header,
+                    "line": self.label_lines.get(header.split("#")[0]),
+                    "depth": depth,
+                    "states": members,
+                    "frames_per_iteration": len(path),
+                    "tasks_per_iteration": sum(tasks[n] for n in path),
+                })
+            report["states"] += len(states)
+            report["tasks"] += sum(tasks.values())
+            report["layers"].append({"name": layer["name"], "states": state_stats, "loops": loop_stats})
+        return report
+
+    def StateFingerprint(self, lines: list) -> str:
+        import hashlib
+        h = hashlib.sha1()
+        # common subexpression elimination changes the instructions of the same lines
+        h.update(b"optimize" if self.optimize else b"no-optimize")
+        for line in lines:
+            h.update(repr(line[0]).encode("utf-8"))
+            h.update(repr([(t.type_, t.index_, t.number_) for t in line[1].tokens]).encode("utf-8"))
+        return h.hexdigest()
+
+    def CompileState(self, name: str, lines: list) -> list:
+        """ Generates the instructions for the lines of one state.
+        The instructions of a state with the same fingerprint in self.state_cache are reused instead. """
+        for line in lines:
+            if line[0] not in self.vars:
+                self.vars[line[0]] = {"constant": False}
+        if not len(lines):
+            return []
+        fingerprint = self.StateFingerprint(lines)
+        instructions = self.state_cache.get(fingerprint)
+        if instructions is None:
+            instructions = []
+            values = ValueTable() if self.optimize else None
+            for line in lines:
+                instructions.extend(self._CompileExpr(line, values))
+            self.AllocateTemps(instructions)
+            self.rebuilt_states.append(name)
+        for instr in instructions:
+            if instr[1].startswith("f#T"):
+                self.temps = max(self.temps, int(instr[1][3:]) + 1)
+        self.states_built[fingerprint] = instructions
+        return list(instructions)
+
+    def PreprocessSource(self):
+        self.statements = []
+        self.positions = []
+        for statement, line, column in self.Preprocess(self.source):
+            self.statements.append(statement)
+            self.positions.append((line, column))
+
     def Compile(self):
-        # remove line comments
-        source = "\n".join([l if not l.startswith("//") else "" for l in self.source.split("\n")])
-        # remove block comments
-        while "/*" in source:
-            head, tail = source.split("/*", maxsplit=1)
-            if "*/" not in tail:
-                self.Error("Missing end comment \"*/\"")
-            ignore, tail = tail.split("*/")
-            source = head + tail
-        # add implied semicolons to ends
-        while "end\n" in source:
-            head, tail = source.split("end\n", maxsplit=1)
-            source = head + "end;\n" + tail
-        # replace placeholder
-        # split code lines
-        source = source.split(";")
+        self.Phase("preprocess", self.PreprocessSource)
         parsed = []
-        self._Compile(source, parsed)
+        self.Phase("parse", self._Compile, 0, parsed)
+        parsed = self.Phase("loops", self.LowerLoops, parsed)
+        if self.optimize:
+            self.Phase("propagate", self.PropagateConstants, parsed)
+        parsed = self.Phase("arrays", self.LowerArrays, parsed)
         if self.debug:
             self.debug_tokens.extend([
                 [str(p[0])]+[self.serialize(token) for token in p[1].tokens] if type(p[1]) is Expression else self.serialize(p) for p in parsed
             ])
+        layer = self.Phase("codegen", self.BuildLayer, parsed)
+        if self.optimize:
+            self.Phase("dead_stores", self.EliminateDeadStores, layer)
+            self.Phase("merge", self.MergeStates, layer)
+        if self.max_state_tasks is not None:
+            self.Phase("split", self.SplitStates, layer, self.max_state_tasks)
+        self.layers.append(layer)
+
+    def Phase(self, name: str, f, *args):
+        """ Runs the pass f(*args) of Compile, adding the seconds it took to phase_times[name] """
+        t = time.perf_counter()
+        result = f(*args)
+        self.phase_times[name] = self.phase_times.get(name, 0.0) + time.perf_counter() - t
+        return result
 
+    def BuildLayer(self, parsed: list) -> dict:
+        """ Splits parsed into states at its labels and generates their instructions and gotos """
         current_layer = {
             "name": "Main Layer",
             "states": {"entry": {"instructions": [], "gotos": []}}
         }
         current_state = "entry"
-        instructions = []
+        lines = []
         gotos = []
         for line in parsed:
             if not len(line):
@@ -535,11 +1812,11 @@ class Compiler:
                 if not any([len(g)<=2 for g in gotos]):
                     gotos.append({"state": line[1]})
                 current_layer["states"][current_state] = {
-                    "instructions": instructions,
+                    "instructions": self.CompileState(current_state, lines),
                     "gotos": gotos,
                 }
                 current_state = line[1]
-                instructions = []
+                lines = []
                 gotos = []
             elif line[0] in ("@GOTO", "@GOTO_UNLESS"):
                 gtst = line[1]
@@ -553,17 +1830,12 @@ class Compiler:
                 if len(line) >= 3:
                     gotos[-1]["condition"] = line[2]
             else:
-                instructions.extend(self._CompileExpr(line))
-        if len(instructions):
-            current_layer["states"][current_state] = {
-                "instructions": instructions,
-                "gotos": gotos,
-            }
-        
+                lines.append(line)
+
         if not any([len(g)<=2 for g in gotos]):
             gotos.append({"state": "end"})
         current_layer["states"][current_state] = {
-            "instructions": [],
+            "instructions": self.CompileState(current_state, lines),
             "gotos": gotos,
         }
 
@@ -571,32 +1843,225 @@ class Compiler:
             "instructions": [],
             "gotos": [],
         }
+        return current_layer
+
+
+
+def BuildFile(ifile: str, ofile: str = None, debug: bool = False, verbose: bool = False, optimize: bool = True,
+              use_cache: bool = True, cache_dir: str = None, stats: bool = False, profile: bool = False,
+              trace_file: str = None, parse_cache: ParseCache = None, binary: bool = False, max_state_tasks: int = None) -> dict:
+    """ Compiles ifile to ofile (ifile + ".asm" by default), going through the build cache unless use_cache is False.
+    With binary, ofile (ifile + ".c2ir" by default) gets the binary IR of binaryir.py instead of text assembly.
+    max_state_tasks caps the driver tasks of a state, see Compiler.
+    Returns a summary of the build. """
+    start = time.perf_counter()
+    if ofile is None:
+        ofile = ifile + (".c2ir" if binary else ".asm")
+    with open(ifile) as f:
+        source = f.read()
 
-        self.layers.append(current_layer)
+    data = None
+    cache = None
+    # debug builds always compile so the debug tokens get written, stats and profiles need the compiled layers
+    if use_cache and not debug and not stats and not profile:
+        from buildcache import BuildCache, DEFAULT_CACHE_DIR
+        cache = BuildCache(cache_dir or DEFAULT_CACHE_DIR)
+        key = cache.Key(source, CompilerVersion(), optimize, max_state_tasks)
+        data = cache.Get(key)
+    cached = data is not None
+
+    if data is None:
+        # reuse the states of the last build of this file that did not change
+        state_cache = cache.GetStates(ifile, CompilerVersion()) if cache is not None else None
+        comp = Compiler(source, debug, parse_cache=parse_cache, state_cache=state_cache, optimize=optimize,
+                        max_state_tasks=max_state_tasks)
+        profiler = None
+        if profile:
+            from profiler import Profiler
+            profiler = Profiler()
+            profiler.Attach(comp)
+        comp.Compile()
+        # stream the assembly to the output rather than holding it in memory, through a temporary file
+        # so a failed build never leaves half an output behind
+        tmp = f"{ofile}.{os.getpid()}.tmp"
+        try:
+            if binary:
+                from binaryir import Program, IRWriter
+                comp.WriteDebugTokens()
+                program = Program.FromLines(comp.IterAssembly())
+                with open(tmp, "wb") as f:
+                    IRWriter(f).Write(program)
+            else:
+                with open(tmp, "w") as f:
+                    comp.WriteAssembly(f)
+            os.replace(tmp, ofile)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        if cache is not None:
+            # the cache holds text assembly, so binary builds only read from it
+            if not binary:
+                cache.PutFile(key, ofile)
+            cache.PutStates(ifile, CompilerVersion(), comp.states_built)
+        if verbose:
+            print(f"Rebuilt {len(comp.rebuilt_states)} of {len(comp.states_built)} states: {', '.join(comp.rebuilt_states)}")
+            print(f"Removed {comp.removed_states} states by merging")
+            print(f"Unrolled {comp.unrolled_loops} loops, split {comp.split_states} states")
+        if stats:
+            import json
+            print(json.dumps(comp.Stats(), indent=2))
+        if profiler is not None:
+            profiler.Stop()
+            print(profiler.Report())
+            if trace_file is not None:
+                profiler.WriteTrace(trace_file)
+    else:
+        if verbose:
+            print("Up to date, using cached assembly")
+        if binary:
+            from binaryir import Program, IRWriter
+            with open(ofile, "wb") as f:
+                IRWriter(f).Write(Program.FromText(data))
+        else:
+            with open(ofile, "w") as f:
+                f.write(data)
+    return {"source": ifile, "output": ofile, "ok": True, "cached": cached, "seconds": time.perf_counter() - start, "error": None}
+
+
+_shared_parse_cache = None
+def SharedParseCache() -> ParseCache:
+    """ The ParseCache, and so the Parser, shared by every build in this process """
+    global _shared_parse_cache
+    if _shared_parse_cache is None:
+        _shared_parse_cache = ParseCache()
+    return _shared_parse_cache
+
+
+def BuildJob(job: tuple) -> dict:
+    """ Runs BuildFile for one (ifile, ofile, options) of a batch, reporting failures in the summary instead of raising """
+    ifile, ofile, options = job
+    start = time.perf_counter()
+    try:
+        return BuildFile(ifile, ofile, parse_cache=SharedParseCache(), **options)
+    except Exception as e:
+        return {"source": ifile, "output": ofile, "ok": False, "cached": False, "seconds": time.perf_counter() - start, "error": str(e)}
 
 
+def ReadManifest(path: str) -> list:
+    """ Reads a JSON manifest listing sources, either as paths or as {"source": path, "output": path} objects.
+    Relative paths are relative to the manifest. Returns (ifile, ofile) pairs, ofile may be None. """
+    import json
+    with open(path) as f:
+        entries = json.load(f)
+    if type(entries) is dict:
+        entries = entries.get("sources", [])
+    base = os.path.dirname(os.path.abspath(path))
+    jobs = []
+    for entry in entries:
+        if type(entry) is str:
+            entry = {"source": entry}
+        ofile = entry.get("output")
+        jobs.append((os.path.join(base, entry["source"]), os.path.join(base, ofile) if ofile is not None else None))
+    return jobs
+
+
+def BuildBatch(jobs: list, options: dict, workers: int = 1) -> list:
+    """ Builds every (ifile, ofile) of jobs in this process, or in a pool of worker processes when workers > 1 """
+    jobs = [(ifile, ofile, options) for ifile, ofile in jobs]
+    if workers > 1 and len(jobs) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(BuildJob, jobs))
+    return [BuildJob(job) for job in jobs]
+
 
 if __name__ == '__main__':
     if len(sys.argv) < 2:
-        print(f"Usage: {sys.argv[0]} source.txt [-d] [-o output.asm]")
+        print(f"Usage: {sys.argv[0]} source.txt... | --server | --listen [host:]port [--manifest manifest.json] [-j workers] [--summary summary.json] [-d] [-o output.asm] [--binary] [-v] [-O0] [--max-state-tasks n] [--stats] [--profile] [--profile-trace trace.json] [--no-cache] [--cache-dir dir]")
+        exit(0)
+
+    if sys.argv[1] in ("--server", "--listen"):
+        from server import CompileServer
+        if sys.argv[1] == "--server":
+            CompileServer().Serve(sys.stdin, sys.stdout)
+        else:
+            address = sys.argv[2] if len(sys.argv) > 2 else "0"
+            host, _, port = address.rpartition(":")
+            CompileServer().Listen(host or "127.0.0.1", int(port))
         exit(0)
 
-    ifile = sys.argv[1]
-    ofile = ifile + ".asm"
-    debug = False
-    for i in range(2, len(sys.argv)):
-        if sys.argv[i] in ("-d", "--debug"):
-            debug = True
-        elif sys.argv[i] in ("-o", "--output") and i+1 < len(sys.argv):
+    ifiles = []
+    ofile = None
+    manifest = None
+    workers = 1
+    summary_file = None
+    options = {}
+    i = 1
+    while i < len(sys.argv):
+        arg = sys.argv[i]
+        has_value = i+1 < len(sys.argv)
+        if arg in ("-d", "--debug"):
+            options["debug"] = True
+        elif arg in ("-o", "--output") and has_value:
             ofile = sys.argv[i+1]
+            i += 1
+        elif arg in ("-v", "--verbose"):
+            options["verbose"] = True
+        elif arg == "--stats":
+            options["stats"] = True
+        elif arg == "--profile":
+            options["profile"] = True
+        elif arg == "--profile-trace" and has_value:
+            options["profile"] = True
+            options["trace_file"] = sys.argv[i+1]
+            i += 1
+        elif arg in ("-O0", "--no-optimize"):
+            options["optimize"] = False
+        elif arg == "--binary":
+            options["binary"] = True
+        elif arg == "--max-state-tasks" and has_value:
+            options["max_state_tasks"] = int(sys.argv[i+1])
+            i += 1
+        elif arg == "--no-cache":
+            options["use_cache"] = False
+        elif arg == "--cache-dir" and has_value:
+            options["cache_dir"] = sys.argv[i+1]
+            i += 1
+        elif arg == "--manifest" and has_value:
+            manifest = sys.argv[i+1]
+            i += 1
+        elif arg == "-j" and has_value:
+            workers = int(sys.argv[i+1])
+            i += 1
+        elif arg == "--summary" and has_value:
+            summary_file = sys.argv[i+1]
+            i += 1
+        else:
+            ifiles.append(arg)
+        i += 1
 
-    with open(ifile) as f:
-        source = f.read()
+    jobs = [(ifile, None) for ifile in ifiles]
+    if manifest is not None:
+        jobs.extend(ReadManifest(manifest))
 
-    comp = Compiler(source, debug)
-    comp.Compile()
-    comp.BuildAssembly()
-    data = comp.Finalize()
+    if len(jobs) == 1 and manifest is None:
+        # a single source keeps failing loudly
+        BuildFile(jobs[0][0], ofile, **options)
+        exit(0)
+    if ofile is not None:
+        print("-o can only be used with a single source file")
+        exit(1)
 
-    with open(ofile, "w") as f:
-        f.write(data)
+    start = time.perf_counter()
+    results = BuildBatch(jobs, options, workers)
+    failed = [r for r in results if not r["ok"]]
+    for r in results:
+        status = "cached" if r["cached"] else "built" if r["ok"] else "FAILED"
+        print(f"{status:>6} {r['seconds']*1000:8.1f} ms  {r['source']}" + (f": {r['error']}" if r["error"] else ""))
+    total = time.perf_counter() - start
+    print(f"{len(results) - len(failed)} of {len(results)} built in {total:.2f}s, {len(failed)} failed")
+    if summary_file is not None:
+        import json
+        with open(summary_file, "w") as f:
+            json.dump({"version": CompilerVersion(), "seconds": total, "builds": results}, f, indent=2)
+    exit(1 if len(failed) else 0)
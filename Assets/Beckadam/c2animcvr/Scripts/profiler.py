@@ -0,0 +1,143 @@
+import time, json, weakref, tracemalloc
+
+
+class Profiler:
+    """ Records the wall time, calls and memory allocated by each phase of a Compiler, and the time spent on each source line.
+    Attach wraps the methods of one compiler instance, so compilers that are not profiled run exactly as before.
+    Memory is traced with tracemalloc from Attach until Stop, which slows down the phases it measures. """
+    PHASES = {
+        "PreprocessSource": "preprocess",
+        "_Compile": "parse",
+        "LowerLoops": "loops",
+        "PropagateConstants": "propagate",
+        "BuildLayer": "codegen",
+        "EliminateDeadStores": "dead_stores",
+        "MergeStates": "merge",
+        "SplitStates": "split",
+        "BuildAssembly": "assembly",
+        "WriteAssembly": "assembly",
+        "Finalize": "finalize",
+    }
+
+    def __init__(self):
+        self.phases = {}
+        self.lines = {}
+        self.events = []
+        # parsed Expression:source line it came from, dropped with the Expression
+        self.expr_lines = weakref.WeakKeyDictionary()
+        # [traced bytes at the start, highest traced bytes since] of each phase running, innermost last
+        self.memory = []
+        self.tracing = False
+        self.comp = None
+        self.start = time.perf_counter()
+
+    def Attach(self, comp):
+        self.comp = comp
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.tracing = True
+        for method, phase in self.PHASES.items():
+            self.WrapPhase(comp, method, phase)
+        # the parse cache may be shared with other compilers, so parsing is timed through this one
+        parse_expr = comp.ParseExpr
+        def ParseExpr(parsed, expr):
+            t = time.perf_counter()
+            result = parse_expr(parsed, expr)
+            self.expr_lines[result] = comp.lineno
+            self.Line(comp.lineno, "parse", t)
+            return result
+        comp.ParseExpr = ParseExpr
+        compile_expr = comp._CompileExpr
+        def _CompileExpr(line, values=None):
+            t = time.perf_counter()
+            result = compile_expr(line, values)
+            self.Line(self.expr_lines.get(line[1]), "codegen", t)
+            return result
+        comp._CompileExpr = _CompileExpr
+        return comp
+
+    def WrapPhase(self, comp, method, phase):
+        f = getattr(comp, method)
+        stats = self.phases.setdefault(phase, {"calls": 0, "seconds": 0.0, "bytes": 0, "peak_bytes": 0})
+        depth = [0]
+        def wrapped(*args, **kwargs):
+            stats["calls"] += 1
+            # recursive calls are part of the outermost one
+            if depth[0]:
+                return f(*args, **kwargs)
+            depth[0] += 1
+            self.EnterMemory()
+            t = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                end = time.perf_counter()
+                depth[0] -= 1
+                stats["seconds"] += end - t
+                allocated, peak = self.ExitMemory()
+                stats["bytes"] += allocated
+                stats["peak_bytes"] = max(stats["peak_bytes"], peak)
+                self.Event(phase, "phase", t, end)
+        setattr(comp, method, wrapped)
+
+    def EnterMemory(self):
+        current, peak = tracemalloc.get_traced_memory()
+        # the peak is reset for this phase, the one around it keeps what it reached so far
+        if len(self.memory):
+            self.memory[-1][1] = max(self.memory[-1][1], peak)
+        tracemalloc.reset_peak()
+        self.memory.append([current, current])
+
+    def ExitMemory(self) -> tuple:
+        """ Returns the bytes the phase left allocated and the most it had allocated at once """
+        current, peak = tracemalloc.get_traced_memory()
+        start, highest = self.memory.pop()
+        highest = max(highest, peak)
+        if len(self.memory):
+            self.memory[-1][1] = max(self.memory[-1][1], highest)
+        return current - start, highest - start
+
+    def Stop(self):
+        """ Stops tracing memory if Attach started it """
+        if self.tracing:
+            tracemalloc.stop()
+            self.tracing = False
+
+    def Line(self, lineno, kind: str, t: float):
+        end = time.perf_counter()
+        stats = self.lines.setdefault(lineno, {"parse": 0.0, "codegen": 0.0, "calls": 0})
+        stats[kind] += end - t
+        stats["calls"] += 1
+        self.Event(f"line {lineno} {kind}", "line", t, end)
+
+    def Event(self, name: str, category: str, t: float, end: float):
+        self.events.append({
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": (t - self.start) * 1e6,
+            "dur": (end - t) * 1e6,
+            "pid": 0,
+            "tid": 0,
+        })
+
+    def SlowestLines(self, count: int = 10) -> list:
+        lines = [(s["parse"] + s["codegen"], n, s) for n, s in self.lines.items() if n is not None]
+        lines.sort(key=lambda l: l[0], reverse=True)
+        return lines[:count]
+
+    def Report(self, count: int = 10) -> str:
+        out = [f"{'phase':<12} {'calls':>8} {'ms':>10} {'KiB':>10} {'peak KiB':>10}"]
+        for phase, stats in self.phases.items():
+            out.append(f"{phase:<12} {stats['calls']:>8} {stats['seconds']*1000:>10.2f} {stats['bytes']/1024:>10.1f} {stats['peak_bytes']/1024:>10.1f}")
+        source = self.comp.source.split("\n") if self.comp is not None else []
+        out.append(f"slowest lines:")
+        for total, lineno, stats in self.SlowestLines(count):
+            text = source[lineno-1].strip(" \t\r") if 0 < lineno <= len(source) else ""
+            out.append(f"  line {lineno}: {total*1000:.2f} ms (parse {stats['parse']*1000:.2f}, codegen {stats['codegen']*1000:.2f}, {stats['calls']} calls) {text}")
+        return "\n".join(out)
+
+    def WriteTrace(self, path: str):
+        """ Writes the recorded events in the Chrome trace format, for chrome://tracing or Perfetto """
+        with open(path, "w") as f:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
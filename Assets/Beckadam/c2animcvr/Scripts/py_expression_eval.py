@@ -13,8 +13,6 @@
 from __future__ import division
 
 import math
-import random
-import re
 
 TNUMBER = 0
 TOP1 = 1
@@ -22,6 +20,27 @@ TOP2 = 2
 TVAR = 3
 TFUNCALL = 4
 
+# patterns are matched in place with pattern.match(expression, pos), never on a slice of the expression.
+# they are compiled by the first parse, so that importing this module does not import re
+SCIENTIFIC_NUMBER = None
+HEX_NUMBER = None
+DECIMAL_NUMBER = None
+# characters a number can start with once operators have been ruled out
+NUMBER_START = frozenset('0123456789.eE')
+# ascii fast paths for identifiers, the scanning loops take over from where these stop
+WORD = None
+VARIABLE = None
+
+
+def compile_patterns():
+    global SCIENTIFIC_NUMBER, HEX_NUMBER, DECIMAL_NUMBER, WORD, VARIABLE
+    import re
+    SCIENTIFIC_NUMBER = re.compile(r'[-+]?[0-9]*\.?[0-9]*[eE][-+]?[0-9]+')
+    HEX_NUMBER = re.compile(r'0x[0-9a-fA-F]+')
+    DECIMAL_NUMBER = re.compile(r'[0-9.]+')
+    WORD = re.compile(r'[A-Za-z][A-Za-z0-9_]*')
+    VARIABLE = re.compile(r'[A-Za-z][A-Za-z0-9_.]*')
+
 
 class Token():
 
@@ -288,6 +307,7 @@ class Parser:
         return -a
 
     def random(self, a):
+        import random
         return random.random() * (a or 1)
 
     def fac(self, a):  # a!
@@ -315,6 +335,7 @@ class Parser:
         return math.degrees(math.atan(a))
 
     def roll(self, a, b):
+        import random
         rolls = []
         roll = 0
         final = 0
@@ -332,6 +353,39 @@ class Parser:
         a.append(b)
         return a
 
+    # operators grouped by their first character, in matching order
+    OPERATORS = {}
+    for token, priority, index in (
+        ('**', 8, '**'),
+        ('^', 8, '^'),
+        ('%', 6, '%'),
+        ('/', 6, '/'),
+        (u'\u2219', 5, '*'), # bullet operator
+        (u'\u2022', 5, '*'), # black small circle
+        ('*', 5, '*'),
+        ('+', 4, '+'),
+        ('-', 4, '-'),
+        ('||', 3, '||'),
+        ('==', 3, '=='),
+        ('!=', 3, '!='),
+        ('<=', 3, '<='),
+        ('>=', 3, '>='),
+        ('<', 3, '<'),
+        ('>', 3, '>'),
+        ('in ', 3, 'in'),
+        ('not ', 2, 'not'),
+        ('and ', 1, 'and'),
+        ('xor ', 0, 'xor'),
+        ('or ', 0, 'or'),
+    ):
+        OPERATORS.setdefault(token[0], []).append((token, priority, index))
+    del token, priority, index
+
+    # names of the operators loadOperators adds, so parsing can tell them apart before they are loaded
+    LAZY_OPS1 = frozenset(('sin', 'cos', 'tan', 'asin', 'acos', 'atan', 'sind', 'cosd', 'tand', 'asind', 'acosd', 'atand'))
+    LAZY_OPS2 = frozenset(('||', 'D'))
+    LAZY_FUNCTIONS = frozenset(('concat',))
+
     def __init__(self, string_literal_quotes = ("'", "\"")):
         self.string_literal_quotes = string_literal_quotes
 
@@ -340,27 +394,16 @@ class Parser:
         self.expression = ''
 
         self.pos = 0
+        self.wordpos = -1
+        self.wordend = -1
 
         self.tokennumber = 0
         self.tokenprio = 0
         self.tokenindex = 0
         self.tmpprio = 0
 
+        # the trigonometric, degree, concatenation and dice operators are added by loadOperators
         self.ops1 = {
-            'sin': math.sin,
-            'cos': math.cos,
-            'tan': math.tan,
-            'asin': math.asin,
-            'acos': math.acos,
-            'atan': math.atan,
-
-            'sind': self.sind,
-            'cosd': self.cosd,
-            'tand': self.tand,
-            'asind': self.asind,
-            'acosd': self.acosd,
-            'atand': self.atand,
-
             'sqrt': math.sqrt,
             'abs': abs,
             'ceil': math.ceil,
@@ -380,7 +423,6 @@ class Parser:
             '^': self.pow,
             '**': self.pow,
             ',': self.append,
-            '||': self.concat,
             "==": self.equal,
             "!=": self.notEqual,
             ">": self.greaterThan,
@@ -391,7 +433,6 @@ class Parser:
             "or": self.orOperator,
             "xor": self.xorOperator,
             "in": self.inOperator,
-            "D": self.roll
         }
 
         self.functions = {
@@ -403,7 +444,6 @@ class Parser:
             'pyt': self.pyt,
             'pow': math.pow,
             'atan2': math.atan2,
-            'concat':self.concat,
             'if': self.ifFunction
         }
 
@@ -437,7 +477,32 @@ class Parser:
             'PI': math.pi
         }
 
+    def loadOperators(self):
+        """ Adds the operators programs rarely use to the tables, the first time parse meets one of them.
+        Returns True so the name checks can load them inline. """
+        self.ops1.update({
+            'sin': math.sin,
+            'cos': math.cos,
+            'tan': math.tan,
+            'asin': math.asin,
+            'acos': math.acos,
+            'atan': math.atan,
+
+            'sind': self.sind,
+            'cosd': self.cosd,
+            'tand': self.tand,
+            'asind': self.asind,
+            'acosd': self.acosd,
+            'atand': self.atand,
+        })
+        self.ops2['||'] = self.concat
+        self.ops2['D'] = self.roll
+        self.functions['concat'] = self.concat
+        return True
+
     def parse(self, expr):
+        if WORD is None:
+            compile_patterns()
         self.errormsg = ''
         self.success = True
         operstack = []
@@ -447,9 +512,13 @@ class Parser:
         noperators = 0
         self.expression = expr
         self.pos = 0
+        self.wordpos = -1
 
         while self.pos < len(self.expression):
-            if self.isOperator():
+            # the current character rules out most token kinds, only the predicates that can match are tried
+            c = self.expression[self.pos]
+            cased = c.upper() != c.lower()
+            if c in self.OPERATORS and self.isOperator():
                 if self.isSign() and expected & self.SIGN:
                     if self.isNegativeSign():
                         self.tokenprio = 5
@@ -470,17 +539,19 @@ class Parser:
                 else:
                     if expected and self.OPERATOR == 0:
                         self.error_parsing(self.pos, 'unexpected operator')
+                    if self.tokenindex in self.LAZY_OPS2 and self.tokenindex not in self.ops2:
+                        self.loadOperators()
                     noperators += 2
                     self.addfunc(tokenstack, operstack, TOP2)
                     expected = \
                         self.PRIMARY | self.LPAREN | self.FUNCTION | self.SIGN
-            elif self.isNumber():
+            elif c in NUMBER_START and self.isNumber():
                 if expected and self.PRIMARY == 0:
                     self.error_parsing(self.pos, 'unexpected number')
                 token = Token(TNUMBER, 0, 0, self.tokennumber)
                 tokenstack.append(token)
                 expected = self.OPERATOR | self.RPAREN | self.COMMA
-            elif self.isString():
+            elif c in self.string_literal_quotes and self.isString():
                 if (expected & self.PRIMARY) == 0:
                     self.error_parsing(self.pos, 'unexpected string')
                 token = Token(TNUMBER, 0, 0, self.tokennumber)
@@ -519,21 +590,23 @@ class Parser:
                 consttoken = Token(TNUMBER, 0, 0, self.tokennumber)
                 tokenstack.append(consttoken)
                 expected = self.OPERATOR | self.RPAREN | self.COMMA
-            elif self.isOp2():
+            elif cased and self.isOp2():
                 if (expected & self.FUNCTION) == 0:
                     self.error_parsing(self.pos, 'unexpected function')
                 self.addfunc(tokenstack, operstack, TOP2)
                 noperators += 2
                 expected = self.LPAREN
-            elif self.isOp1():
+            elif cased and self.isOp1():
                 if (expected & self.FUNCTION) == 0:
                     self.error_parsing(self.pos, 'unexpected function')
                 self.addfunc(tokenstack, operstack, TOP1)
                 noperators += 1
                 expected = self.LPAREN
-            elif self.isVar():
+            elif (cased or c == '"') and self.isVar():
                 if (expected & self.PRIMARY) == 0:
                     self.error_parsing(self.pos, 'unexpected variable')
+                if self.tokenindex in self.LAZY_FUNCTIONS and self.tokenindex not in self.functions:
+                    self.loadOperators()
                 vartoken = Token(TVAR, self.tokenindex, 0, 0)
                 tokenstack.append(vartoken)
                 expected = \
@@ -579,43 +652,35 @@ class Parser:
         operstack.append(operator)
 
     def isNumber(self):
-        r = False
-
         if self.expression[self.pos] == 'E':
             return False
 
         # number in scientific notation
-        pattern = r'([-+]?([0-9]*\.?[0-9]*)[eE][-+]?[0-9]+).*'
-        match = re.match(pattern, self.expression[self.pos: ])
+        match = SCIENTIFIC_NUMBER.match(self.expression, self.pos)
         if match:
-            self.pos += len(match.group(1))
-            self.tokennumber = float(match.group(1))
+            self.pos = match.end()
+            self.tokennumber = float(match.group())
             return True
 
-        hex_pattern = r'(0x[0-9a-fA-F]+)'
-        match = re.match(hex_pattern, self.expression[self.pos: ])
+        match = HEX_NUMBER.match(self.expression, self.pos)
         if match:
-            self.pos += len(match.group(1))
-            self.tokennumber = int(match.group(1), base=16)
+            self.pos = match.end()
+            self.tokennumber = int(match.group(), base=16)
             return True
 
         # number in decimal
-        str = ''
-        while self.pos < len(self.expression):
-            code = self.expression[self.pos]
-            if (code >= '0' and code <= '9') or code == '.':
-                if (len(str) == 0 and code == '.' ):
-                    str = '0'
-                str += code
-                self.pos += 1
-                try:
-                    self.tokennumber = int(str)
-                except ValueError:
-                    self.tokennumber = float(str)
-                r = True
-            else:
-                break
-        return r
+        match = DECIMAL_NUMBER.match(self.expression, self.pos)
+        if match:
+            str = match.group()
+            if str[0] == '.':
+                str = '0' + str
+            self.pos = match.end()
+            try:
+                self.tokennumber = int(str)
+            except ValueError:
+                self.tokennumber = float(str)
+            return True
+        return False
 
     def unescape(self, v, pos):
         buffer = []
@@ -692,8 +757,7 @@ class Parser:
     def isConst(self):
         for i in self.consts:
             L = len(i)
-            str = self.expression[self.pos:self.pos+L]
-            if i == str:
+            if self.expression.startswith(i, self.pos):
                 if len(self.expression) <= self.pos + L:
                     self.tokennumber = self.consts[i]
                     self.pos += L
@@ -705,30 +769,7 @@ class Parser:
         return False
 
     def isOperator(self):
-        ops = (
-            ('**', 8, '**'),
-            ('^', 8, '^'),
-            ('%', 6, '%'),
-            ('/', 6, '/'),
-            (u'\u2219', 5, '*'), # bullet operator
-            (u'\u2022', 5, '*'), # black small circle
-            ('*', 5, '*'),
-            ('+', 4, '+'),
-            ('-', 4, '-'),
-            ('||', 3, '||'),
-            ('==', 3, '=='),
-            ('!=', 3, '!='),
-            ('<=', 3, '<='),
-            ('>=', 3, '>='),
-            ('<', 3, '<'),
-            ('>', 3, '>'),
-            ('in ', 3, 'in'),
-            ('not ', 2, 'not'),
-            ('and ', 1, 'and'),
-            ('xor ', 0, 'xor'),
-            ('or ', 0, 'or'),
-        )
-        for token, priority, index in ops:
+        for token, priority, index in self.OPERATORS.get(self.expression[self.pos], ()):
             if self.expression.startswith(token, self.pos):
                 self.tokenprio = priority
                 self.tokenindex = index
@@ -749,8 +790,7 @@ class Parser:
         return code == '-'
 
     def isLogicalNot(self):
-        code = self.expression[self.pos - 4: self.pos]
-        return code == 'not '
+        return self.pos >= 4 and self.expression.startswith('not ', self.pos - 4)
 
     def isLeftParenth(self):
         code = self.expression[self.pos]
@@ -784,51 +824,60 @@ class Parser:
             return True
         return False
 
-    def isOp1(self):
-        str = ''
-        for i in range(self.pos, len(self.expression)):
+    def wordEnd(self):
+        # the word at a position is scanned once and shared by isOp2 and isOp1
+        if self.wordpos == self.pos:
+            return self.wordend
+        match = WORD.match(self.expression, self.pos)
+        i = match.end() if match else self.pos
+        while i < len(self.expression):
             c = self.expression[i]
             if c.upper() == c.lower():
                 if i == self.pos or (c != '_' and (c < '0' or c > '9')):
                     break
-            str += c
-        if len(str) > 0 and str in self.ops1:
-            self.tokenindex = str
-            self.tokenprio = 9
-            self.pos += len(str)
-            return True
+            i += 1
+        self.wordpos = self.pos
+        self.wordend = i
+        return i
+
+    def isOp1(self):
+        end = self.wordEnd()
+        if end > self.pos:
+            str = self.expression[self.pos:end]
+            if str in self.ops1 or str in self.LAZY_OPS1 and self.loadOperators():
+                self.tokenindex = str
+                self.tokenprio = 9
+                self.pos = end
+                return True
         return False
 
     def isOp2(self):
-        str = ''
-        for i in range(self.pos, len(self.expression)):
-            c = self.expression[i]
-            if c.upper() == c.lower():
-                if i == self.pos or (c != '_' and (c < '0' or c > '9')):
-                    break
-            str += c
-        if len(str) > 0 and (str in self.ops2):
-            self.tokenindex = str
-            self.tokenprio = 9
-            self.pos += len(str)
-            return True
+        end = self.wordEnd()
+        if end > self.pos:
+            str = self.expression[self.pos:end]
+            if str in self.ops2 or str in self.LAZY_OPS2 and self.loadOperators():
+                self.tokenindex = str
+                self.tokenprio = 9
+                self.pos = end
+                return True
         return False
 
     def isVar(self):
-        str = ''
         inQuotes = False
-        for i in range(self.pos, len(self.expression)):
+        match = VARIABLE.match(self.expression, self.pos)
+        i = match.end() if match else self.pos
+        while i < len(self.expression):
             c = self.expression[i]
             if c.lower() == c.upper():
                 if ((i == self.pos and c != '"') or (not (c in '_."') and (c < '0' or c > '9'))) and not inQuotes :
                     break
             if c == '"':
                 inQuotes = not inQuotes
-            str += c
-        if str:
-            self.tokenindex = str
+            i += 1
+        if i > self.pos:
+            self.tokenindex = self.expression[self.pos:i]
             self.tokenprio = 6
-            self.pos += len(str)
+            self.pos = i
             return True
         return False
 
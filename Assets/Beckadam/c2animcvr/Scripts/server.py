@@ -0,0 +1,109 @@
+import io, json, time, socketserver
+from collections import OrderedDict
+from contextlib import redirect_stdout
+from c2animcvr import Compiler, CompilerVersion, SharedParseCache
+from buildcache import BuildCache
+
+
+class CompileServer:
+    """ Compiles requests without restarting, keeping the parser, the parsed expressions and the built states warm.
+    Requests and responses are JSON objects, one per line:
+    {"id": 1, "source": "...", "path": "file.txt", "optimize": true, "max_state_tasks": null, "stats": false} compiles source (or the file at path),
+    {"command": "ping"} and {"command": "shutdown"} do what they say.
+    A response echoes the id and has "ok", plus "assembly" and "diagnostics" or "error". """
+    def __init__(self, max_entries: int = 256):
+        self.parse_cache = SharedParseCache()
+        self.keys = BuildCache()
+        self.max_entries = max_entries
+        # build key:assembly of recent builds, and source path:states of its last build
+        self.assembly = OrderedDict()
+        self.states = {}
+        self.requests = 0
+        self.running = True
+
+    def Compile(self, request: dict) -> dict:
+        source = request.get("source")
+        path = request.get("path")
+        if source is None:
+            if path is None:
+                return {"ok": False, "error": "Missing source"}
+            with open(path) as f:
+                source = f.read()
+        optimize = request.get("optimize", True)
+        max_state_tasks = request.get("max_state_tasks")
+        key = self.keys.Key(source, CompilerVersion(), optimize, max_state_tasks)
+        if key in self.assembly and not request.get("stats"):
+            self.assembly.move_to_end(key)
+            return {"ok": True, "cached": True, "assembly": self.assembly[key], "diagnostics": []}
+        # the compiler reports errors on stdout, which may be the protocol stream
+        out = io.StringIO()
+        try:
+            with redirect_stdout(out):
+                comp = Compiler(source, parse_cache=self.parse_cache, state_cache=self.states.get(path), optimize=optimize,
+                                max_state_tasks=max_state_tasks)
+                comp.Compile()
+                comp.BuildAssembly()
+                data = comp.Finalize()
+        except Exception as e:
+            return {"ok": False, "error": str(e), "diagnostics": out.getvalue().splitlines()}
+        self.assembly[key] = data
+        if len(self.assembly) > self.max_entries:
+            self.assembly.popitem(last=False)
+        if path is not None:
+            self.states[path] = comp.states_built
+        response = {"ok": True, "cached": False, "assembly": data, "diagnostics": out.getvalue().splitlines()}
+        if request.get("stats"):
+            response["stats"] = comp.Stats()
+        return response
+
+    def Handle(self, request: dict) -> dict:
+        self.requests += 1
+        start = time.perf_counter()
+        command = request.get("command", "compile")
+        if command == "compile":
+            response = self.Compile(request)
+        elif command == "ping":
+            response = {"ok": True, "version": CompilerVersion(), "requests": self.requests}
+        elif command == "shutdown":
+            self.running = False
+            response = {"ok": True}
+        else:
+            response = {"ok": False, "error": f"Unknown command \"{command}\""}
+        if "id" in request:
+            response["id"] = request["id"]
+        response["seconds"] = time.perf_counter() - start
+        return response
+
+    def Serve(self, reader, writer):
+        """ Answers the requests read from reader until it closes or a shutdown is requested """
+        for line in reader:
+            if not len(line.strip()):
+                continue
+            try:
+                request = json.loads(line)
+                if type(request) is not dict:
+                    raise ValueError("Requests must be JSON objects")
+            except ValueError as e:
+                response = {"ok": False, "error": f"Bad request: {e}"}
+            else:
+                try:
+                    response = self.Handle(request)
+                except Exception as e:
+                    response = {"ok": False, "id": request.get("id"), "error": str(e)}
+            writer.write(json.dumps(response) + "\n")
+            writer.flush()
+            if not self.running:
+                break
+
+    def Listen(self, host: str = "127.0.0.1", port: int = 0):
+        """ Serves connections on a local TCP socket one at a time, port 0 picks a free port """
+        server = self
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                reader = io.TextIOWrapper(self.rfile, encoding="utf-8")
+                writer = io.TextIOWrapper(self.wfile, encoding="utf-8", write_through=True)
+                server.Serve(reader, writer)
+        with socketserver.TCPServer((host, port), Handler) as tcp:
+            print(f"Listening on {tcp.server_address[0]}:{tcp.server_address[1]}", flush=True)
+            while self.running:
+                tcp.handle_request()
@@ -0,0 +1,311 @@
+import sys, math, json, struct
+
+# AnimatorDriver tasks evaluate conditions and logic operators as true at >= 0.5
+def Truthy(v: float) -> bool:
+    return v >= 0.5
+
+def Float32(v: float) -> float:
+    """ Rounds v to the nearest float the animator can hold """
+    try:
+        return struct.unpack("f", struct.pack("f", v))[0]
+    except OverflowError:
+        return math.copysign(math.inf, v)
+
+def Guarded(f):
+    """ Returns f with the float results C# gives instead of the exceptions Python raises """
+    def g(*args):
+        try:
+            return f(*args)
+        except ZeroDivisionError:
+            return math.copysign(math.inf, args[0]) if args[0] else math.nan
+        except (ValueError, OverflowError):
+            return math.nan
+    return g
+
+OPERATORS = {
+    "set": lambda a: a,
+    "add": lambda a,b: a + b,
+    "sub": lambda a,b: a - b,
+    "mul": lambda a,b: a * b,
+    "div": Guarded(lambda a,b: a / b),
+    "mod": Guarded(lambda a,b: math.fmod(a, b)),
+    "pow": Guarded(lambda a,b: math.pow(a, b)),
+    "log": Guarded(lambda a: math.log(a)),
+    "eq": lambda a,b: float(a == b),
+    "ne": lambda a,b: float(a != b),
+    "lt": lambda a,b: float(a < b),
+    "le": lambda a,b: float(a <= b),
+    "gt": lambda a,b: float(a > b),
+    "ge": lambda a,b: float(a >= b),
+    "ip": Guarded(lambda a: float(math.trunc(a))),
+    "fp": Guarded(lambda a: a - math.trunc(a)),
+    "land": lambda a,b: float(Truthy(a) and Truthy(b)),
+    "lor": lambda a,b: float(Truthy(a) or Truthy(b)),
+    "and": Guarded(lambda a,b: int(a) & int(b)),
+    "or": Guarded(lambda a,b: int(a) | int(b)),
+    "xor": Guarded(lambda a,b: int(a) ^ int(b)),
+    "shl": Guarded(lambda a,b: int(a) * 2**int(b)),
+    "shr": Guarded(lambda a,b: int(a) // 2**int(b)),
+    "rol": Guarded(lambda a,b: (int(a) << (int(b) % 32) | (int(a) & 0xffffffff) >> (32 - int(b) % 32)) & 0xffffffff),
+    "ror": Guarded(lambda a,b: ((int(a) & 0xffffffff) >> (int(b) % 32) | int(a) << (32 - int(b) % 32)) & 0xffffffff),
+    "cond": lambda a,b,c: b if Truthy(a) else c,
+}
+
+
+class Simulator:
+    """ Runs the assembly read by AnimatorCompiler.cs the way the generated animator would.
+    Every layer enters one state per frame and runs its tasks, then the next frame takes the first goto_if (parameter > 0)
+    or goto_unless (parameter < 1) that holds, or else the goto. A layer with nowhere to go has halted. """
+    def __init__(self, text: str):
+        self.lineno = 0
+        self.speed = 30.0
+        self.vars = {}
+        self.params = {}
+        self.macros = {}
+        self.layers = []
+        self.outputs = []
+        self.memories = []
+        self.frames = 0
+        self.tasks = 0
+        self.states = 0
+        self.current_layer = None
+        self.current_state = None
+        self.Parse(text)
+
+    def Error(self, m="Syntax"):
+        print(f"Error on line {self.lineno}: {m}")
+        raise RuntimeError(f"Error: {m}")
+
+    def Operand(self, s: str):
+        """ Returns ("const", value) or (type, name) for an instruction argument """
+        s = s.strip(" \t")
+        if not len(s):
+            return ("const", 0.0)
+        if s == "true":
+            return ("const", 1.0)
+        if s == "false":
+            return ("const", 0.0)
+        if s.startswith("0x"):
+            try:
+                # the assembler reads hex into a 32 bit int, which wraps around
+                return ("const", float((int(s[2:], 16) + 0x80000000) % 0x100000000 - 0x80000000))
+            except ValueError:
+                self.Error(f"Failed to parse number: {s}")
+        if s[0] in "0123456789-.":
+            try:
+                return ("const", Float32(float(s)))
+            except ValueError:
+                self.Error(f"Failed to parse number: {s}")
+        if s[0] not in "fibt":
+            self.Error(f"Failed to determine variable type: {s}")
+        return (s[0], s[1:])
+
+    def Parse(self, text: str):
+        macro = None
+        for line in text.split("\n"):
+            self.lineno += 1
+            line = line.strip(" \t\r")
+            if len(line) < 2 or line[0] == ';':
+                continue
+            if macro is not None:
+                if line == "end macro":
+                    self.macros[macro[0]] = macro[1:]
+                    macro = None
+                else:
+                    macro[2].append(line)
+                continue
+            arg0 = line.split(" ")[0]
+            args = line[len(arg0)+1:].split(",")
+            if arg0 == "speed":
+                self.speed = float(args[0])
+            elif arg0 == "memory":
+                if len(args) != 6:
+                    self.Error("Incorrect number of arguments to memory: must be 6 (base,size,faddrparam,fvalueparam,breadparam,bwriteparam)")
+                base, size = int(args[0]), int(args[1])
+                params = [self.Operand(a) for a in args[2:]]
+                if [p[0] for p in params] != ["f", "f", "b", "b"]:
+                    self.Error("Wrong parameter types to memory: must be float, float, bool, bool")
+                self.memories.append({
+                    "base": base,
+                    "cells": [0.0] * size,
+                    "addr": params[0][1],
+                    "value": params[1][1],
+                    "read": params[2][1],
+                    "write": params[3][1],
+                })
+            elif arg0 == "macro":
+                macro = [args[0].strip(" \t"), [a.strip(" \t") for a in args[1:]], []]
+            elif arg0 == "layer":
+                self.current_layer = {"name": args[0], "states": {}}
+            elif arg0 == "state":
+                if self.current_layer is None:
+                    self.Error("state is only valid within a layer")
+                self.current_state = {"tasks": [], "after": None, "transitions": []}
+                self.current_layer["states"][args[0]] = self.current_state
+            elif arg0 in ("goto_if", "goto_unless"):
+                if self.current_state is None:
+                    self.Error(f"{arg0} is only valid within a state")
+                if len(args) != 2:
+                    self.Error(f"{arg0} requires exactly 2 arguments")
+                self.current_state["transitions"].append((args[1].strip(" \t"), self.Operand(args[0])[1], arg0 == "goto_unless"))
+            elif arg0 == "goto":
+                if self.current_state is None:
+                    self.Error("goto is only valid within a state")
+                self.current_state["after"] = args[0]
+            elif arg0 == "output":
+                if self.current_layer is not None:
+                    self.Error("output is only valid outside of a layer")
+                if len(args) != 2 and len(args) != 3:
+                    self.Error("output requires exactly 2 or 3 arguments")
+                self.outputs.append(self.Operand(args[0])[1])
+            elif arg0 == "var":
+                v = self.Operand(args[0])
+                if v[0] == "const":
+                    self.Error("Variable name cannot be a number or boolean")
+                self.vars[v[1]] = v[0]
+                self.params[v[1]] = 0.0
+            elif arg0 == "end":
+                if args[0] == "layer":
+                    self.layers.append(self.current_layer)
+                    self.current_layer = None
+                elif args[0] == "state":
+                    self.current_state = None
+                else:
+                    self.Error(f"Unknown end argument: {args[0]}")
+            elif arg0 in OPERATORS:
+                ops = [self.Operand(a) for a in args]
+                if self.current_state is None:
+                    self.Error("Instructions are only valid within a state")
+                if len(ops) != self.Arity(arg0) + 1:
+                    self.Error(f"Incorrect number of arguments to operator {arg0}: should be {self.Arity(arg0) + 1}")
+                if ops[0][0] == "const":
+                    self.Error(f"Cannot assign to a constant: {args[0]}")
+                self.current_state["tasks"].append((OPERATORS[arg0], ops[0], ops[1:]))
+            elif arg0 in self.macros:
+                names, contents = self.macros[arg0]
+                # replace macro parameters with arguments verbatim, like the assembler
+                insert = "\n".join(contents)
+                for j in range(len(names)):
+                    insert = insert.replace(names[j], args[j] if j < len(args) else "")
+                lineno = self.lineno
+                self.Parse(insert)
+                self.lineno = lineno
+            else:
+                self.Error(f"Unknown opcode: {arg0}")
+
+    def Arity(self, op: str) -> int:
+        if op in ("set", "ip", "fp", "log"):
+            return 1
+        if op == "cond":
+            return 3
+        return 2
+
+    def Value(self, operand) -> float:
+        if operand[0] == "const":
+            return operand[1]
+        return self.params.get(operand[1], 0.0)
+
+    def Store(self, target, value: float):
+        if target[0] == "i":
+            value = float(math.trunc(value)) if math.isfinite(value) else 0.0
+        elif target[0] in ("b", "t"):
+            value = float(Truthy(value))
+        self.params[target[1]] = Float32(value)
+
+    def Enter(self, state: dict):
+        self.states += 1
+        for f, target, args in state["tasks"]:
+            self.Store(target, f(*[self.Value(a) for a in args]))
+            self.tasks += 1
+
+    def Next(self, state: dict):
+        """ Returns the name of the state to go to from state, or None """
+        for dest, param, inverted in state["transitions"]:
+            value = self.params.get(param, 0.0)
+            if (value < 1.0) if inverted else (value > 0.0):
+                return dest
+        return state["after"]
+
+    def UpdateMemory(self):
+        for mem in self.memories:
+            index = self.params.get(mem["addr"], 0.0) - mem["base"]
+            inside = index == int(index) and 0 <= index < len(mem["cells"])
+            if Truthy(self.params.get(mem["read"], 0.0)):
+                if inside:
+                    self.params[mem["value"]] = mem["cells"][int(index)]
+                self.params[mem["read"]] = 0.0
+            if Truthy(self.params.get(mem["write"], 0.0)):
+                if inside:
+                    mem["cells"][int(index)] = self.params.get(mem["value"], 0.0)
+                self.params[mem["write"]] = 0.0
+
+    def Run(self, max_frames: int = 100000) -> bool:
+        """ Runs until every layer has halted or max_frames frames have passed.
+        Returns whether the program halted. """
+        current = []
+        for layer in self.layers:
+            if not len(layer["states"]):
+                continue
+            name = next(iter(layer["states"]))
+            current.append([layer, name])
+        self.frames = 1
+        for c in current:
+            self.Enter(c[0]["states"][c[1]])
+        self.UpdateMemory()
+        while self.frames < max_frames:
+            moved = False
+            for c in current:
+                dest = self.Next(c[0]["states"][c[1]])
+                if dest is None:
+                    continue
+                if dest not in c[0]["states"]:
+                    self.Error(f"Animator state {dest} is undefined!")
+                c[1] = dest
+                self.Enter(c[0]["states"][dest])
+                moved = True
+            if not moved:
+                return True
+            self.frames += 1
+            self.UpdateMemory()
+        return False
+
+    def Results(self) -> dict:
+        return {
+            "frames": self.frames,
+            "states": self.states,
+            "tasks": self.tasks,
+            "outputs": {name: self.params.get(name, 0.0) for name in self.outputs},
+            "params": dict(self.params),
+        }
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print(f"Usage: {sys.argv[0]} program.asm [--max-frames n] [--set name=value] [--json]")
+        exit(0)
+
+    ifile = sys.argv[1]
+    max_frames = 100000
+    inputs = {}
+    as_json = False
+    for i in range(2, len(sys.argv)):
+        if sys.argv[i] == "--max-frames" and i+1 < len(sys.argv):
+            max_frames = int(sys.argv[i+1])
+        elif sys.argv[i] == "--set" and i+1 < len(sys.argv):
+            name, value = sys.argv[i+1].split("=", maxsplit=1)
+            inputs[name] = float(value)
+        elif sys.argv[i] == "--json":
+            as_json = True
+
+    with open(ifile) as f:
+        sim = Simulator(f.read())
+    sim.params.update(inputs)
+    halted = sim.Run(max_frames)
+    results = sim.Results()
+    results["halted"] = halted
+    if as_json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{'Halted' if halted else 'Still running'} after {sim.frames} frames, {sim.states} states entered, {sim.tasks} tasks run")
+        for name, value in results["params"].items():
+            print(f"{'output ' if name in results['outputs'] else ''}{name} = {value}")
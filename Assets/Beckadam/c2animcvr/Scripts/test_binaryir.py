@@ -0,0 +1,47 @@
+import io, os, glob, unittest
+from binaryir import Program, IRWriter, IRReader, CheckRoundTrip
+from c2animcvr import Compiler
+
+EXAMPLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "examples")
+
+# arrays with variable indices and every builtin the compiler expands
+SOURCE = """
+array cells[8];
+for I=0; I<8; I=I+1;
+    cells[I] = I * X;
+end
+cells[Index] = sqrt(abs(X)) + exp(Y);
+a = floor(X) + ceil(Y) + round(X * Y) - X;
+b = min(cells[Index], max(X, Y)) + (not X);
+output a -> display:material._A;
+output b -> display:material._B;
+"""
+
+
+class RoundTripTest(unittest.TestCase):
+    def assertRoundTrip(self, text: str):
+        program = Program.FromText(text)
+        out = io.BytesIO()
+        IRWriter(out).Write(program)
+        self.assertEqual(program, IRReader(io.BytesIO(out.getvalue())).Read())
+        self.assertEqual(out.getvalue(), CheckRoundTrip(text))
+
+    def test_examples(self):
+        paths = sorted(glob.glob(os.path.join(EXAMPLES_DIR, "*.asm")))
+        self.assertTrue(len(paths))
+        for path in paths:
+            with self.subTest(path=os.path.basename(path)):
+                with open(path) as f:
+                    self.assertRoundTrip(f.read())
+
+    def test_compiled(self):
+        for optimize in (True, False):
+            with self.subTest(optimize=optimize):
+                comp = Compiler(SOURCE, optimize=optimize)
+                comp.Compile()
+                comp.BuildAssembly()
+                self.assertRoundTrip(comp.Finalize())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,207 @@
+import os, glob, math, unittest
+from c2animcvr import Compiler
+from simulator import Simulator
+
+EXAMPLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "examples")
+
+# programs exercising each pass, run with the INPUTS below
+PROGRAMS = {
+    "propagation": """
+a = 2;
+b = a * 3 + X;
+if X > 1;
+    a = 5;
+end
+c = a + b;
+label again;
+d = a * 2;
+output c;
+output d;
+""",
+    "subexpressions": """
+a = (X+Y)*(X+Y) + (X-Y)*(X*Y+Z);
+b = X * Y;
+X = X + 1;
+c = X * Y + b;
+output a;
+output c;
+""",
+    "dead_stores": """
+t = X * 2;
+t = X + 1;
+u = t * t;
+t = 4;
+output u;
+""",
+    "merge": """
+i = 0;
+n = 0;
+while i < 5;
+    i = i + 1;
+    if i > X;
+        n = n + i;
+    end;else;
+        n = n - 1;
+    end
+end
+repeat n < 20;
+    n = n + 3;
+end
+output i;
+output n;
+""",
+    "arrays": """
+array sq[8];
+for I=0; I<8; I=I+1;
+    sq[I] = I * X;
+end
+sq[Index] = Y;
+if X > 1;
+    sq[Index + 1] = Z;
+end
+t = sq[Select] + sq[2];
+for K=0; K<8; K=K+2;
+    if sq[K] > 3;
+        t = t + sq[K];
+    end
+end
+output t;
+""",
+    "unrolled": """
+total = 0;
+for I=0; I<10; I=I+1;
+    total = total + I * X;
+end
+acc = 0;
+for A=0; A<4; A=A+1;
+    for B=0; B<A; B=B+1;
+        acc = acc + A * 10 + B + X;
+    end
+end
+for J=100; J>0; J=J-3;
+    acc = acc + rol(J, 3) * X + J / 7;
+end
+output total;
+output I;
+output acc;
+output J;
+""",
+    "partly_unrolled": """
+s = 0;
+for I=3; I<=1000; I=I+7;
+    s = s + I * X + bxor(I, 5);
+end
+for I=0; I<Y; I=I+1;
+    s = s + I;
+end
+for I=0; I<4; I=I+1;
+    label here;
+    s = s + 1;
+end
+output s;
+output I;
+""",
+}
+INPUTS = (
+    {},
+    {"X": 2.5, "Y": -1.0, "Z": 3.0, "Index": 5.0, "Select": 6.0},
+    {"X": -0.75, "Y": 4.0, "Z": 0.1, "Index": -3.0, "Select": 9.0},
+)
+
+
+def Run(source: str, inputs: dict = None, **options) -> dict:
+    """ Compiles source and runs it in the simulator, returning the values of its outputs and whether it halted """
+    comp = Compiler(source, **options)
+    comp.Compile()
+    comp.BuildAssembly()
+    sim = Simulator(comp.Finalize())
+    sim.params.update(inputs or {})
+    halted = sim.Run(10000)
+    return {"halted": halted, "outputs": sim.Results()["outputs"]}
+
+
+class OptimizerTest(unittest.TestCase):
+    def assertSameResults(self, source: str, inputs: dict = None, **options):
+        """ Checks that source gives the same outputs optimized as it does with -O0 """
+        expected = Run(source, inputs, optimize=False)
+        actual = Run(source, inputs, **options)
+        self.assertEqual(expected["halted"], actual["halted"])
+        self.assertEqual(expected["outputs"].keys(), actual["outputs"].keys())
+        for name, value in expected["outputs"].items():
+            if math.isnan(value):
+                self.assertTrue(math.isnan(actual["outputs"][name]), name)
+            else:
+                self.assertEqual(value, actual["outputs"][name], name)
+
+    def test_programs(self):
+        for name, source in PROGRAMS.items():
+            for max_state_tasks in (None, 1, 4, 16):
+                for inputs in INPUTS:
+                    with self.subTest(program=name, max_state_tasks=max_state_tasks, inputs=inputs):
+                        self.assertSameResults(source, inputs, max_state_tasks=max_state_tasks)
+
+    def test_examples(self):
+        paths = sorted(glob.glob(os.path.join(EXAMPLES_DIR, "*.txt")))
+        self.assertTrue(len(paths))
+        for path in paths:
+            with open(path) as f:
+                source = f.read()
+            for inputs in INPUTS:
+                with self.subTest(example=os.path.basename(path), inputs=inputs):
+                    self.assertSameResults(source, inputs)
+
+    def test_failing_folds(self):
+        # operations on constants that fail in Python are left for the animator
+        for source in (
+            "v = 0; a = 3 / v; output a;",
+            "v=0; a = 3 % v; output a;",
+            "v=5; a = sqrt(-v); output a;",
+            "v=2; if x>0.5; a = v/0; end\noutput a;",
+            "a = 3 / 0; output a;",
+            "a = log(0); output a;",
+        ):
+            with self.subTest(source=source):
+                self.assertSameResults(source, {"x": 1.0})
+
+    def test_float32_folds(self):
+        # folds give the 32 bit floats the animator computes, not Python's 64 bit ones
+        for source in (
+            "a = 16777216; a = a + 1; a = a + 1; output a;",
+            "a = 0.1; a = a + 0.2; output a;",
+            "v = 10; a = exp(v); output a;",
+            "v = 2; a = sqrt(v); output a;",
+            "a = 2147483647; c = a - 1; output c;",
+            "a = 16777217 + 0; output a;",
+        ):
+            with self.subTest(source=source):
+                self.assertSameResults(source)
+
+    def test_float32_loops(self):
+        # unrolled loops run as many times as the animator would run them
+        for source in (
+            "n = 0; for I=8388600; I<8388608.5; I=I+1; n = n + 1; end\noutput n;",
+            "n = 0; for I=8388600; I<=8388609.5; I=I+1; n = n + I; end\noutput n;",
+            "n = 0; for I=16777210; I<16777217; I=I+2; n = n + 1; end\noutput n;",
+            "n = 0; for I=16777217; I>16777200; I=I-4; n = n + I; end\noutput n;",
+        ):
+            with self.subTest(source=source):
+                comp = Compiler(source)
+                comp.Compile()
+                self.assertEqual(comp.unrolled_loops, 1)
+                self.assertSameResults(source)
+
+    def test_reduced_tasks(self):
+        # rewrites down to an operand still take the set copying it
+        source = "a = X * 1; b = X + 0 + Y; X = X * 1; c = pow(Y, 2); d = pow(Y, 0);\n" \
+                 "output a; output b; output c; output d; output X;"
+        self.assertSameResults(source, {"X": 3.0, "Y": 5.0})
+        tasks = []
+        for optimize in (False, True):
+            comp = Compiler(source, optimize=optimize)
+            comp.Compile()
+            tasks.append(comp.Stats()["tasks"])
+        self.assertEqual(comp.Stats()["reduced_tasks"], tasks[0] - tasks[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+import unittest
+from c2animcvr import Compiler, ParseCache
+from profiler import Profiler
+
+SOURCE = """
+array cells[4];
+a = X * 2 + cells[Index];
+output a -> display:material._A;
+"""
+
+
+def Build(source: str, parse_cache: ParseCache, profiler: Profiler = None) -> str:
+    comp = Compiler(source, parse_cache=parse_cache)
+    if profiler is not None:
+        profiler.Attach(comp)
+    comp.Compile()
+    comp.BuildAssembly()
+    if profiler is not None:
+        profiler.Stop()
+    return comp.Finalize()
+
+
+class ProfilerTest(unittest.TestCase):
+    def test_shared_cache(self):
+        # a profiled build leaves the parse cache it shares with later builds as it was
+        cache = ParseCache()
+        expected = Build(SOURCE, ParseCache())
+        profiler = Profiler()
+        self.assertEqual(Build(SOURCE, cache, profiler), expected)
+        self.assertNotIn("Parse", vars(cache))
+        events, lines = len(profiler.events), dict(profiler.lines)
+        self.assertGreater(events, 0)
+        self.assertEqual(Build(SOURCE.replace("X", "Y"), cache), expected.replace("fX", "fY"))
+        self.assertEqual(len(profiler.events), events)
+        self.assertEqual(profiler.lines, lines)
+
+    def test_lines(self):
+        profiler = Profiler()
+        Build(SOURCE, ParseCache(), profiler)
+        self.assertEqual(profiler.lines[3]["calls"], 2)
+        self.assertGreater(profiler.lines[3]["codegen"], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,180 @@
+var fsquares#0
+var fsquares#1
+var fsquares#2
+var fsquares#3
+var fsquares#4
+var fsquares#5
+var fsquares#6
+var fsquares#7
+var fsquares#8
+var fsquares#9
+var fsquares#10
+var fsquares#11
+var fsquares#12
+var fsquares#13
+var fsquares#14
+var fsquares#15
+var f#AC
+var f#L0
+var fpicked
+output fpicked, display,material._Value
+layer Main Layer
+state entry
+set fsquares#0, 0
+set fsquares#1, 1
+set fsquares#2, 4
+set fsquares#3, 9
+set fsquares#4, 16
+set fsquares#5, 25
+set fsquares#6, 36
+set fsquares#7, 49
+set fsquares#8, 64
+set fsquares#9, 81
+set fsquares#10, 100
+set fsquares#11, 121
+set fsquares#12, 144
+set fsquares#13, 169
+set fsquares#14, 196
+set fsquares#15, 225
+ge f#AC, fSelect, 8
+goto_unless f#AC, A2_0_8
+goto A2_8_16
+end state
+state A2_0_8
+ge f#AC, fSelect, 4
+goto_unless f#AC, A2_0_4
+goto A2_4_8
+end state
+state A2_0_4
+ge f#AC, fSelect, 2
+goto_unless f#AC, A2_0_2
+goto A2_2_4
+end state
+state A2_0_2
+ge f#AC, fSelect, 1
+goto_unless f#AC, A2_0_1
+goto A2_1_2
+end state
+state A2_0_1
+set f#L0, fsquares#0
+goto A2End
+end state
+state A2_1_2
+set f#L0, fsquares#1
+goto A2End
+end state
+state A2_2_4
+ge f#AC, fSelect, 3
+goto_unless f#AC, A2_2_3
+goto A2_3_4
+end state
+state A2_2_3
+set f#L0, fsquares#2
+goto A2End
+end state
+state A2_3_4
+set f#L0, fsquares#3
+goto A2End
+end state
+state A2_4_8
+ge f#AC, fSelect, 6
+goto_unless f#AC, A2_4_6
+goto A2_6_8
+end state
+state A2_4_6
+ge f#AC, fSelect, 5
+goto_unless f#AC, A2_4_5
+goto A2_5_6
+end state
+state A2_4_5
+set f#L0, fsquares#4
+goto A2End
+end state
+state A2_5_6
+set f#L0, fsquares#5
+goto A2End
+end state
+state A2_6_8
+ge f#AC, fSelect, 7
+goto_unless f#AC, A2_6_7
+goto A2_7_8
+end state
+state A2_6_7
+set f#L0, fsquares#6
+goto A2End
+end state
+state A2_7_8
+set f#L0, fsquares#7
+goto A2End
+end state
+state A2_8_16
+ge f#AC, fSelect, 12
+goto_unless f#AC, A2_8_12
+goto A2_12_16
+end state
+state A2_8_12
+ge f#AC, fSelect, 10
+goto_unless f#AC, A2_8_10
+goto A2_10_12
+end state
+state A2_8_10
+ge f#AC, fSelect, 9
+goto_unless f#AC, A2_8_9
+goto A2_9_10
+end state
+state A2_8_9
+set f#L0, fsquares#8
+goto A2End
+end state
+state A2_9_10
+set f#L0, fsquares#9
+goto A2End
+end state
+state A2_10_12
+ge f#AC, fSelect, 11
+goto_unless f#AC, A2_10_11
+goto A2_11_12
+end state
+state A2_10_11
+set f#L0, fsquares#10
+goto A2End
+end state
+state A2_11_12
+set f#L0, fsquares#11
+goto A2End
+end state
+state A2_12_16
+ge f#AC, fSelect, 14
+goto_unless f#AC, A2_12_14
+goto A2_14_16
+end state
+state A2_12_14
+ge f#AC, fSelect, 13
+goto_unless f#AC, A2_12_13
+goto A2_13_14
+end state
+state A2_12_13
+set f#L0, fsquares#12
+goto A2End
+end state
+state A2_13_14
+set f#L0, fsquares#13
+goto A2End
+end state
+state A2_14_16
+ge f#AC, fSelect, 15
+goto_unless f#AC, A2_14_15
+goto A2_15_16
+end state
+state A2_14_15
+set f#L0, fsquares#14
+goto A2End
+end state
+state A2_15_16
+set f#L0, fsquares#15
+goto A2End
+end state
+state A2End
+add fpicked, f#L0, fsquares#1
+end state
+end layer
\ No newline at end of file
@@ -0,0 +1,16 @@
+var fa
+var f#T0
+var f#T1
+var f#T2
+output fa, display,material._Value
+layer Main Layer
+state entry
+add f#T0, fx, fy
+mul f#T0, f#T0, f#T0
+sub f#T1, fx, fy
+mul f#T2, fx, fy
+add f#T2, f#T2, fz
+mul f#T1, f#T1, f#T2
+add fa, f#T0, f#T1
+end state
+end layer
\ No newline at end of file